@@ -1,15 +1,60 @@
 # THIS FILE IS COPIED FROM THE PIDCalib package from the LHCbSoftware stack
+# The RooBinning objects have been replaced by NumPy edge arrays, so that the
+# module can be imported without ROOT
 
-import ROOT
+import numpy as np
 from PIDPerfScripts.Definitions import *
 
 __all__=('CheckBinScheme', 'AddBinScheme',
          'SetDefaultBinScheme', 'AddUniformBins',
          'AddBinBoundary', 'GetBinScheme')
 
+class _BinScheme(object):
+    """Bin boundaries of a scheme in the range [xMin, xMax], with the """
+    """semantics of RooBinning. Boundaries are only collected when the """
+    """scheme is defined, the sorted edge array is built on first use and """
+    """cached until the scheme is changed."""
+
+    def __init__(self, xMin, xMax):
+        self.xMin = float(xMin)
+        self.xMax = float(xMax)
+        self.boundaries = [self.xMin, self.xMax]
+        self.uniform = []
+        self.edges = None
+
+    def copy(self):
+        rv = _BinScheme(self.xMin, self.xMax)
+        rv.boundaries = list(self.boundaries)
+        rv.uniform = list(self.uniform)
+        rv.edges = self.edges
+        return rv
+
+    def add(self, boundary):
+        self.boundaries.append(float(boundary))
+        self.edges = None
+
+    def add_uniform(self, nBins, xMin, xMax):
+        self.uniform.append((nBins, xMin, xMax))
+        self.edges = None
+
+    def get_edges(self):
+        if self.edges is None:
+            parts = [np.array(self.boundaries)]
+            for nBins, xMin, xMax in self.uniform:
+                # Same boundaries as RooBinning::addUniform
+                i = np.arange(nBins + 1)
+                parts.append((nBins - i) / float(nBins) * xMin +
+                             i / float(nBins) * xMax)
+            edges = np.unique(np.concatenate(parts))
+            # Like RooBinning, only boundaries inside the range are bins
+            edges = edges[(edges >= self.xMin) & (edges <= self.xMax)]
+            edges.flags.writeable = False
+            self.edges = edges
+        return self.edges
+
 _BinSchemes={}
 for trackType in GetPartTypes():
-    for varName,varNameInDataSet in DataSetVariables().iteritems():
+    for varName,varNameInDataSet in DataSetVariables().items():
         _BinSchemes.setdefault(trackType,{})
         _BinSchemes[trackType][varName]={}
 
@@ -24,10 +69,9 @@ Return True if the requested scheme name is found."""
 
     CheckPartType(trackType)
     CheckVarName(varName)
-    schemeNames = _BinSchemes[trackType][varName].keys()
+    schemeNames = sorted(_BinSchemes[trackType][varName].keys())
     if schemeName not in schemeNames:
         if errorOnMissing:
-            schemeNames.sort()
             msg=("Scheme name '{sname}' not in the list of bin schemes for "
             "variable '{vname}'. Possible schemes are {snames}").format(
                 sname=schemeName, vname=varName, snames=str(schemeNames))
@@ -52,8 +96,7 @@ If 'replaceCurrentScheme' is False, then a KeyError will be raised """
         raise KeyError(msg)
 
 
-    _BinSchemes[trackType][varName][schemeName]=ROOT.RooBinning(xMin, xMax,
-        varName)
+    _BinSchemes[trackType][varName][schemeName]=_BinScheme(xMin, xMax)
 
 def SetDefaultBinScheme(trackType, varName, schemeName):
     """Set the default binning scheme for the specified track type and """
@@ -62,37 +105,35 @@ If 'muonUnBiased' is False, the default scheme for RICH calibration is set, """
     """otherwise the default scheme for muon calibration is set.
 Raises a KeyError if a scheme with the requested name does not exist."""
     CheckBinScheme(trackType, varName, schemeName)
-    _BinSchemes[trackType][varName]['default']=ROOT.RooBinning(
-        _BinSchemes[trackType][varName][schemeName], varName)
+    _BinSchemes[trackType][varName]['default']=\
+        _BinSchemes[trackType][varName][schemeName].copy()
 
 def AddUniformBins(trackType, varName, schemeName, nBins, xMin, xMax):
     """Adds 'nBins' bins, uniform in the range [xMin, xMax] to the binning """
     """scheme of the specified track type and bin variable.
 Raises a KeyError if a scheme with the requested name does not exist."""
     CheckBinScheme(trackType, varName, schemeName)
-    _BinSchemes[trackType][varName][schemeName].addUniform(nBins, xMin, xMax)
+    _BinSchemes[trackType][varName][schemeName].add_uniform(nBins, xMin,
+                                                           xMax)
 
 def AddBinBoundary(trackType, varName, schemeName, boundary):
     """Adds a new bin boundary to the binning scheme of the specified """
     """track type and bin variable.
 Raises a KeyError if a scheme with the requested name does not exist."""
     CheckBinScheme(trackType, varName, schemeName)
-    _BinSchemes[trackType][varName][schemeName].addBoundary(boundary)
+    _BinSchemes[trackType][varName][schemeName].add(boundary)
 
 def GetBinScheme(trackType, varName, schemeName=None):
-    """Returns a copy of the requested binning scheme (we don't want the """
-    """user to modify the original scheme).
+    """Returns the bin edges of the requested binning scheme as a read-only """
+    """NumPy array (we don't want the user to modify the original scheme).
+The array is built on first use and cached.
 If no scheme name is specified, then the default calibration scheme is """
     """used instead.
 Raises a KeyError if a scheme with the requested name does not exist."""
-    if schemeName is not None:
-        CheckBinScheme(trackType, varName, schemeName)
-        return ROOT.RooBinning(_BinSchemes[trackType][varName][schemeName],
-            varName)
-    else:
-        CheckBinScheme(trackType, varName, 'default')
-        return ROOT.RooBinning(_BinSchemes[trackType][varName]['default'],
-            varName)
+    if schemeName is None:
+        schemeName = 'default'
+    CheckBinScheme(trackType, varName, schemeName)
+    return _BinSchemes[trackType][varName][schemeName].get_edges()
 
 ###########################################################################
 ######        Here, we make the default binning schemes              ######
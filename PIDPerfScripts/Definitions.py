@@ -1,5 +1,6 @@
 # THIS FILE IS COPIED FROM THE PIDCalib package from the LHCbSoftware stack
 
+from __future__ import print_function
 import re
 import math
 
@@ -144,7 +145,7 @@ def NtupleVariables(var=None):
         return h[var]
 
 def GetVarNames():
-    varArr = [varName for varName, varNameInDataset in DataSetVariables().iteritems()]
+    varArr = [varName for varName, varNameInDataset in DataSetVariables().items()]
     varArr.sort()
     return varArr
 
@@ -295,7 +296,7 @@ def CheckCutVarsInTree(cuts,tree):
                 pass
             #print var,"is not mathematical or a function"
             tree_vars = tree.GetListOfLeaves()
-            for i in xrange(len(tree_vars)):
+            for i in range(len(tree_vars)):
                 if tree_vars[i].GetName() == var:
                     #print var,"==",tree_vars[i].GetName()
                     found = True
@@ -313,7 +314,7 @@ def CheckCuts(cuts,triggers=[]):
         simple_cuts = simple_cuts.replace(i," ")
 
     simple_cuts = [x for x in simple_cuts.split(" ") if x!=""]
-    valid_varibles = [x for x,y in DataSetVariables().iteritems()]
+    valid_varibles = [x for x,y in DataSetVariables().items()]
 
     for t in triggers:
         for suffix in ["","_Dec","_TIS","_TOS"]:
@@ -326,10 +327,10 @@ def CheckCuts(cuts,triggers=[]):
             float(var)
         except ValueError:
             if var not in valid_varibles:
-                print "'%s' is not a valid variable"%var
-                print "Known variables are:"
-                print valid_varibles
-                print triggers
+                print("'%s' is not a valid variable"%var)
+                print("Known variables are:")
+                print(valid_varibles)
+                print(triggers)
                 return False
     return True
 
@@ -1,15 +1,13 @@
 # THIS FILE IS COPIED FROM THE PIDCalib package from the LHCbSoftware stack
 
-import exceptions
-
-class GetEnvError(exceptions.Exception):
+class GetEnvError(Exception):
     pass
 
-class TFileError(exceptions.Exception):
+class TFileError(Exception):
     pass
 
-class RooWorkspaceError(exceptions.Exception):
+class RooWorkspaceError(Exception):
     pass
 
-class RooDataSetError(exceptions.Exception):
+class RooDataSetError(Exception):
     pass
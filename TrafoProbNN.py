@@ -1,9 +1,7 @@
 #!/usr/bin/python
+from __future__ import print_function
 import ROOT
-import array
-import itertools
 import numpy as np
-import math
 from argparse import ArgumentParser
 import os.path
 
@@ -24,12 +22,10 @@ def get_any_tree(tfilepath):
 
 def back_transform(var):
     '''
-    Performs the back transformation of ProbNN variables, using numpy magic
-    for huge speedup when passing arrays to this function.
-    This function does not return anything, but changes the passed array in
-    place.
-    For the per-event back transformation when looping over a TTree use
-    UntrafoProbNN
+    Performs the back transformation exp(var) / (1 + exp(var)) of ProbNN
+    variables on a whole array and returns the result. Values below -500
+    (problematic ProbNN values that were set to -1000 by `transform`) are
+    set to -2.
     '''
     error_mask = var < -500
 
@@ -37,32 +33,154 @@ def back_transform(var):
         np.exp(var) / (1 + np.exp(var)))
 
 
-def trafoProbNN(variable_name, event):
+def transform(var):
     '''
-    calculates the transformation of a given variable
+    Performs the transformation log(var / (1 - var)) of ProbNN variables on a
+    whole array. Returns the transformed array and the number of problematic
+    values outside of (0, 1), which are set to -1000.
     '''
-    variable = event.__getattr__(variable_name)
+    var = np.asarray(var, dtype=float)
+    #-1000 or -2 is the default value when ProbNN could not be read when creating the tuples
+    problems = (var <= 0.0) | (var >= 1.0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result = np.log(var / (1 - var))
+    result[problems] = -1000.
+    return result, int(np.count_nonzero(problems))
 
-    #Check for problematic ProbNN values
-    if variable <= 0.0 or variable >= 1.0:  #-1000 or -2 is the default value when ProbNN could not be read when creating the tuples
-        problem_branches[variable_name] = problem_branches.get(
-            variable_name, 0) + 1
-        return -1000.  #also return -1000
 
-    return np.log(variable / (1 - variable))
+def output_branch_name(variable_name, reverse=False):
+    if reverse:
+        #If var-name has "Trafo" in it, change it to "Untrafo", otherwise append Untrafo
+        if "Trafo" in variable_name:
+            return variable_name.replace("Trafo", "Untrafo")
+        return variable_name + "_Untrafo"
+    return variable_name + "_Trafo"
 
 
-def UntrafoProbNN(variable_name, event):
+def open_input_tree(inputfilename, treename=None):
     '''
-    calculates the inverse transformation of a given variable
+    Returns the input tree, its name and the opened file (which has to be
+    kept as long as the tree is used). Files written by the grab_data method
+    contain many cycles of the same tree, these are chained.
     '''
-    variable = event.__getattr__(variable_name)
+    from root_numpy import list_trees
+    if treename is None:
+        treename = get_any_tree(inputfilename)
+
+    trees = list_trees(inputfilename)
+
+    # If data was downloaded with grab_data method, you end up with many trees in your file
+    if len(trees) > 1:
+        inputtree = ROOT.TChain("tree")
+        for i in range(1, len(trees) + 1):
+            filename = inputfilename + "/tree;{}".format(i)
+            status = inputtree.Add(filename, -1)
+            if status == 0:
+                break
+        return inputtree, treename, None
+
+    inputfile = ROOT.TFile(inputfilename, "READ")
+    if not inputfile.IsOpen():
+        raise SystemExit("Could not open inputfile!")
+    return inputfile.Get(treename), treename, inputfile
+
+
+def transform_file(inputfilename,
+                   outputfilename,
+                   treename=None,
+                   variables=(),
+                   patterns=None,
+                   reverse=False,
+                   chunksize=500000):
+    '''
+    Copies the input tree to the output file and adds the (back) transformed
+    ProbNN branches. The tree is copied without decompressing it, the new
+    branches are computed column-wise in chunks of `chunksize` entries.
+    Returns the number of entries and the number of problematic values per
+    branch.
+    '''
+    from root_numpy import tree2array, array2tree
+
+    inputtree, inputtreename, inputfile = open_input_tree(
+        inputfilename, treename)
+
+    #Get explicit variable names and those matching the patterns (if applicable)
+    variable_names = list(variables)
+    for pattern in patterns or []:
+        for branch in inputtree.GetListOfBranches():
+            if pattern in branch.GetName() and \
+                    branch.GetName() not in variable_names:
+                variable_names.append(branch.GetName())
+
+    if len(variable_names) == 0:
+        raise SystemExit("No variables for transformation given/found for {}".
+                         format(inputfilename))
+
+    output_names = [
+        output_branch_name(name, reverse) for name in variable_names
+    ]
+
+    entries = inputtree.GetEntries()
+    print("Processing {0} entries in {2} /{1}".format(entries, inputtreename,
+                                                      inputfilename))
+    print("\nThe following variables will be transformed:")
+    print(", ".join(variable_names))
+    print("\n")
+
+    #Clone tree
+    outputfile = ROOT.TFile(outputfilename, "RECREATE")
+    outputtree = inputtree.CloneTree(-1, "fast")
+
+    # Create dictionary that will contain the branch names, where invalid ProbNN values were encountered (i.e. outside of 0 to 1)
+    # and attached to the branch names the number of events there an error occured
+    problem_branches = {}
+
+    for start in range(0, entries, chunksize):
+        chunk = tree2array(
+            inputtree,
+            branches=variable_names,
+            start=start,
+            stop=start + chunksize)
+        columns = []
+        for variable_name in variable_names:
+            if reverse:
+                columns.append(back_transform(chunk[variable_name]))
+            else:
+                result, problems = transform(chunk[variable_name])
+                if problems:
+                    problem_branches[variable_name] = problem_branches.get(
+                        variable_name, 0) + problems
+                columns.append(result)
+        outputfile.cd()
+        array2tree(
+            np.rec.fromarrays(columns, names=output_names), tree=outputtree)
+
+    print("\nFinished processing {0} entries in {2} /{1}\n\t=> Writing to {3}".
+          format(entries, inputtreename, inputfilename, outputfilename))
+    outputfile.cd()
+    outputtree.Write()
+    outputfile.Close()
+    return entries, problem_branches
+
+
+def print_problem_branches(inputfilename, entries, problem_branches):
+    if problem_branches:
+        print(
+            "\n\nWARNING: There were events with ProbNN-values outside the allowed region of [0,1] for {}:".
+            format(inputfilename))
+        print("{:<20} {:>15} {:>10}".format('Branch', 'Probl. Events',
+                                            'Percent'))
+        for branch, events in problem_branches.items():
+            print("{:<20} {:>15} {:>10}%".format(
+                branch, events, float(events) / entries * 100.))
+        print(
+            "\t=> Setting these to -1000 (Default value for ProbNN-variables if none was found when creating the ntuple)"
+        )
 
-    #Check for problematic transformed ProbNN values
-    if variable < -500:
-        return -2.
-    else:
-        return np.exp(variable) / (1 + np.exp(variable))
+
+def _transform_job(args):
+    inputfilename, outputfilename, kwargs = args
+    return transform_file(inputfilename, outputfilename, **kwargs)
 
 
 if __name__ == '__main__':
@@ -79,8 +197,9 @@ if __name__ == '__main__':
         "--input",
         dest="Input",
         action="store",
+        nargs="+",
         required=True,
-        help="Input ROOT-file")
+        help="Input ROOT-file(s)")
     parser.add_argument(
         "-t",
         "--tree",
@@ -95,8 +214,8 @@ if __name__ == '__main__':
         dest="Output",
         action="store",
         required=True,
-        help="Output ROOT-file")
-    #parser.add_argument( "--progress", dest="progress", action="store_true", default=False, required=False, help="Show detailed progressbar")
+        help="Output ROOT-file. If several input files are given, this is the "
+        "directory the output files are written to.")
     parser.add_argument(
         "Variables",
         metavar='V',
@@ -117,142 +236,47 @@ if __name__ == '__main__':
         action="store_true",
         help="Perform inverse transformation exp(X_ProbNNY)/(1+exp(X_ProbNNY))"
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        dest="Jobs",
+        type=int,
+        default=1,
+        help="Number of input files that are processed in parallel")
+    parser.add_argument(
+        "--chunksize",
+        dest="Chunksize",
+        type=int,
+        default=500000,
+        help="Number of entries that are transformed at once")
 
     #Parse arguments from command line
     options = parser.parse_args()
 
-    #Open tree and clone it
-    inputfile = ROOT.TFile(options.Input, "READ")
-    if not inputfile.IsOpen():
-        raise SystemExit("Could not open inputfile!")
-
-    if options.Tree == None:
-        inputtreename = get_any_tree(options.Input)
+    kwargs = dict(
+        treename=options.Tree,
+        variables=options.Variables,
+        patterns=options.Patterns,
+        reverse=options.Reverse,
+        chunksize=options.Chunksize)
+    if len(options.Input) == 1:
+        jobs = [(options.Input[0], options.Output, kwargs)]
     else:
-        inputtreename = options.Tree
-
-    from root_numpy import list_trees
-    trees = list_trees(options.Input)
-
-    # If data was downloaded with grab_data method, you end up with many trees in your file
-    if len(trees) > 1:
-        inputtree=ROOT.TChain("tree")
-        for i in range(1,len(trees)+1):
-            filename = options.Input + "/tree;{}".format(i)
-            status = inputtree.Add(filename,-1)
-            if status == 0:
-                break
+        if not os.path.isdir(options.Output):
+            os.makedirs(options.Output)
+        jobs = [(inputfilename,
+                 os.path.join(options.Output,
+                              os.path.basename(inputfilename)), kwargs)
+                for inputfilename in options.Input]
+
+    if options.Jobs > 1 and len(jobs) > 1:
+        import multiprocessing as mp
+        pool = mp.Pool(processes=min(options.Jobs, len(jobs)))
+        results = pool.map(_transform_job, jobs)
+        pool.close()
     else:
-        inputtree = inputfile.Get(inputtreename)
-
-
-    print 'Entries', inputtree.GetEntries()
-
-    outputfile = options.Output
-
-    #Clone tree
-    outputfile = ROOT.TFile(options.Output, "RECREATE")
-    outputtree = inputtree.CloneTree(0)
-
-    #Get explicit variable names
-    variable_names = options.Variables
-
-    #Create new branches for explicit variable names
-    variable_trafo_branches = []
-    for variable_name in variable_names:
-        variable_trafo_branches.append(array.array("d", [0.0]))
-        if options.Reverse:
-            #If var-name has "Trafo" in it, change it to "Untrafo", otherwise append Untrafo
-            if "Trafo" in variable_name:
-                outputbranchname = variable_name.replace("Trafo", "Untrafo")
-            else:
-                outputbranchname = variable_name + "_Untrafo"
-            outputtree.Branch(outputbranchname, variable_trafo_branches[-1],
-                              outputbranchname + "/D")
-        else:
-            outputtree.Branch(variable_name + "_Trafo",
-                              variable_trafo_branches[-1],
-                              variable_name + "_Trafo/D")
-
-    #Get variable names matching the patterns (if applicable)
-    if options.Patterns:
-        for pattern in options.Patterns:
-            for branch in inputtree.GetListOfBranches():
-                if pattern in branch.GetName():
-                    variable_name = branch.GetName()
-                    variable_names.append(variable_name)
-                    variable_trafo_branches.append(array.array("d", [0.0]))
-                    if options.Reverse:
-                        #If var-name has "Trafo" in it, change it to "Untrafo", otherwise append Untrafo
-                        if "Trafo" in variable_name:
-                            outputbranchname = variable_name.replace(
-                                "Trafo", "Untrafo")
-                        else:
-                            outputbranchname = variable_name + "_Untrafo"
-                        outputtree.Branch(outputbranchname,
-                                          variable_trafo_branches[-1],
-                                          outputbranchname + "/D")
-                    else:
-                        outputtree.Branch(variable_name + "_Trafo",
-                                          variable_trafo_branches[-1],
-                                          variable_name + "_Trafo/D")
-
-    if len(variable_names) is 0:
-        raise SystemExit("No variables for transformation given/found for {}".
-                         format(options.Input))
-
-    # Create dictionary that will contain the branch names, where invalid ProbNN values were encountered (i.e. outside of 0 to 1)
-    # and attached to the branch names the number of events there an error occured
-    problem_branches = {}
-
-    #Progressbar
-    entries = inputtree.GetEntries()
-    print("Processing {0} entries in {2} /{1}".format(entries, inputtreename,
-                                                      options.Input))
-    print("\nThe following variables will be transformed:")
-    print(", ".join(variable_names))
-    print("\n")
-
-    #widgets = [os.path.basename(options.Output), progressbar.Percentage(), ' ', progressbar.Bar(), ' ', progressbar.ETA()]
-    #pbar = progressbar.ProgressBar(widgets=widgets, maxval=entries).start()
-
-    #pbar.update(0)
-    #Iterate through tree
-    for (i, event) in itertools.izip(xrange(entries), inputtree):
-        inputtree.GetEntry(i)
+        results = [_transform_job(job) for job in jobs]
 
-        #iterate through variables
-        for (variable_name, variable_trafo_branch) in itertools.izip(
-                variable_names, variable_trafo_branches):
-            if options.Reverse:
-                variable_trafo_branch[0] = UntrafoProbNN(variable_name, event)
-            else:
-                variable_trafo_branch[0] = trafoProbNN(variable_name, event)
-
-        #Fill tree
-        outputtree.Fill()
-
-        #Progressbar
-    #    if options.progress:    #detailed progress
-    #        pbar.update(i+1)
-    #    else:
-    #        if (i+1) % (entries/10) == 0:
-    #            pbar.update(i+1)
-
-    if problem_branches:
-        print(
-            "\n\nWARNING: There were events with ProbNN-values outside the allowed region of [0,1] for {}:".
-            format(options.Input))
-        print("{:<20} {:>15} {:>10}".format('Branch', 'Probl. Events',
-                                            'Percent'))
-        for branch, events in problem_branches.iteritems():
-            print("{:<20} {:>15} {:>10}%".format(
-                branch, events, float(events) / entries * 100.))
-        print(
-            "\t=> Setting these to -1000 (Default value for ProbNN-variables if none was found when creating the ntuple)"
-        )
-
-    print("\nFinished processing {0} entries in {2} /{1}\n\t=> Writing to {3}".
-          format(entries, inputtreename, options.Input, options.Output))
-    outputtree.Write()
-    outputfile.Close()
+    for (inputfilename, _, _), (entries, problem_branches) in zip(
+            jobs, results):
+        print_problem_branches(inputfilename, entries, problem_branches)
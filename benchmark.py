@@ -0,0 +1,356 @@
+#!/usr/bin/env python
+'''
+Throughput benchmarks for the resampling machinery on synthetic data.
+
+Generates calibration samples (P, ETA, nTracks, PID variables and sWeights)
+and simulated samples with realistic kinematic distributions, times every
+stage for several event counts and binning schemes and reports events per
+second and peak memory as JSON. Results can be compared to an earlier run to
+catch performance regressions:
+
+    python benchmark.py --output new.json --compare old.json
+'''
+from __future__ import print_function
+import argparse
+import json
+import logging
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import pidtool
+
+STAGES = ['learn', 'bank_learn', 'freeze', 'sample', 'backends',
+          'create_resamplers', 'resample_branch']
+
+# Number of events per task when measuring the overhead of the backends
+BACKEND_CHUNKSIZE = 10000
+
+
+def generate_calibration(n, seed=0, particle='K'):
+    '''
+    Returns a dict of columns that look like a PIDCalib calibration sample:
+    falling momentum spectrum, pseudorapidity peaked in the LHCb acceptance,
+    track multiplicity from a gamma distribution, DLL and ProbNN variables
+    that depend on the momentum and sWeights with a negative tail.
+    '''
+    rng = np.random.RandomState(seed)
+    p = 3000 + rng.exponential(25000, n)
+    eta = np.clip(rng.normal(3.2, 0.6, n), 1.5, 5)
+    ntracks = rng.gamma(3, 60, n).astype(int)
+    # PID separation degrades with momentum
+    width = 10 + p / 5000.
+    data = {
+        '{}_P'.format(particle): p,
+        '{}_Eta'.format(particle): eta,
+        'nTracks': ntracks,
+        # signal weights, about 10% of the entries get a negative weight
+        'nsig_sw': rng.normal(0.9, 0.4, n),
+    }
+    for var in ['CombDLLK', 'CombDLLmu', 'CombDLLp', 'CombDLLe']:
+        data['{}_{}'.format(particle, var)] = rng.normal(20, width)
+    for tune in ['V2', 'V3']:
+        for var in ['K', 'pi', 'mu', 'p', 'e', 'ghost']:
+            data['{}_{}ProbNN{}'.format(particle, tune, var)] = rng.beta(
+                2, 5, n)
+    return data
+
+
+def generate_mc(n, seed=1, particle='K'):
+    '''
+    Returns a dict of columns of a simulated sample with the features used in
+    the resampling
+    '''
+    rng = np.random.RandomState(seed)
+    return {
+        '{}_P'.format(particle): 3000 + rng.exponential(25000, n),
+        '{}_ETA'.format(particle): np.clip(rng.normal(3.2, 0.6, n), 1.5, 5),
+        'nTracks': rng.gamma(3, 60, n).astype(int)
+    }
+
+
+def kinematic_binning(scheme, particle='K'):
+    '''
+    Returns the P, ETA and nTracks bin edges of a PIDCalib binning scheme
+    '''
+    from PIDPerfScripts.Binning import GetBinScheme
+    return [
+        GetBinScheme(particle, var, scheme) for var in ['P', 'ETA', 'nTracks']
+    ]
+
+
+def measure(func, n_events):
+    '''
+    Runs `func` once and returns its wall time, throughput and the peak of
+    the memory traced by tracemalloc (which includes numpy arrays) as well as
+    the maximum resident set size of the process so far.
+    '''
+    tracemalloc.start()
+    start = time.time()
+    func()
+    elapsed = time.time() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {
+        'seconds': elapsed,
+        'events_per_second': n_events / elapsed if elapsed > 0 else None,
+        'peak_traced_mb': peak / 1024.**2,
+        'max_rss_mb': max_rss / 1024.
+    }
+
+
+def bench_in_memory(n, scheme, stages, particle='K'):
+    '''
+    Benchmarks learning and sampling without any file I/O
+    '''
+    results = {}
+    calib = generate_calibration(n, particle=particle)
+    mc = generate_mc(n, particle=particle)
+    binning = kinematic_binning(scheme, particle)
+    target = np.linspace(-150, 150, 300)
+    resampler_type = pidtool.Resampler if scheme != 'highres' \
+        else pidtool.SparseResampler
+    kin = [
+        calib['{}_P'.format(particle)], calib['{}_Eta'.format(particle)],
+        calib['nTracks']
+    ]
+    dll = calib['{}_CombDLLK'.format(particle)]
+
+    resampler = resampler_type(*(binning + [target]))
+    if 'learn' in stages:
+        results['learn'] = measure(
+            lambda: resampler.learn(kin + [dll], weights=calib['nsig_sw']),
+            n)
+    else:
+        resampler.learn(kin + [dll], weights=calib['nsig_sw'])
+
+    if 'bank_learn' in stages:
+        pids = [
+            name for name in calib
+            if 'DLL' in name and name.startswith(particle)
+        ]
+        bank = pidtool.ResamplerBank({
+            pid: resampler_type(*(binning + [target]))
+            for pid in pids
+        })
+        results['bank_learn'] = measure(
+            lambda: bank.learn(kin, {pid: calib[pid] for pid in pids},
+                               weights=calib['nsig_sw']),
+            n * len(pids))
+
+    frozen = []
+    if 'freeze' in stages:
+        results['freeze'] = measure(
+            lambda: frozen.append(resampler.freeze()), n)
+    else:
+        frozen.append(resampler.freeze())
+
+    if 'sample' in stages:
+        features = np.array([
+            mc['{}_P'.format(particle)], mc['{}_ETA'.format(particle)],
+            mc['nTracks']
+        ])
+        results['sample'] = measure(lambda: frozen[0].sample(features), n)
+    if 'backends' in stages:
+        features = np.array([
+            mc['{}_P'.format(particle)], mc['{}_ETA'.format(particle)],
+            mc['nTracks']
+        ])
+        results.update(bench_backends(frozen[0], features))
+    return results
+
+
+def bench_backends(resampler, features, chunksize=BACKEND_CHUNKSIZE):
+    '''
+    Samples `features` in tasks of `chunksize` events with a single worker
+    of every resample_branch backend. Besides the throughput, the time per
+    task that is not spent sampling (pickling, transfer and scheduling) is
+    reported as `overhead_ms_per_task`.
+    '''
+    results = {}
+    n = features.shape[1]
+    tasks = [(features[:, start:start + chunksize], None, 'pid', None)
+             for start in range(0, n, chunksize)]
+    for backend in ['processes', 'threads']:
+        pool = pidtool.sampling_pool(backend, 1, {None: {
+            'pid': resampler
+        }}, {None: None})
+        try:
+            out = []
+            result = measure(
+                lambda: out.extend(pool.map(pidtool._resample_timed, tasks)),
+                n)
+        finally:
+            pool.terminate()
+        sampling = sum(seconds for _, seconds in out)
+        result['overhead_ms_per_task'] = (
+            result['seconds'] - sampling) / len(tasks) * 1000.
+        results['sample_' + backend] = result
+    return results
+
+
+def bench_files(n, scheme, stages, workdir, particle='K'):
+    '''
+    Benchmarks create_resamplers and resample_branch end to end on synthetic
+    ROOT files written to `workdir`
+    '''
+    import pandas as pd
+    from root_pandas import to_root
+    results = {}
+    sample = {
+        'particle': 'Kaon',
+        'branch_particle': particle,
+        'magnet': 'Up',
+        'stripping': 'Bench',
+        'paths': []
+    }
+    config = os.path.join(workdir, 'raw_data.json')
+    with open(config, 'w') as f:
+        json.dump([sample], f)
+    to_root(
+        pd.DataFrame(generate_calibration(n, particle=particle)),
+        os.path.join(workdir, 'Kaon_StrippingBench_MagnetUp.root'),
+        key='tree')
+    args = [
+        'create_resamplers', workdir, workdir, '--config', config,
+        '--binning-scheme', scheme, '--format', 'store'
+    ]
+    if scheme == 'highres':
+        args.append('--sparse')
+    options = pidtool.parser.parse_args(args)
+    if 'create_resamplers' in stages:
+        results['create_resamplers'] = measure(
+            lambda: options.func(options), n)
+    else:
+        options.func(options)
+
+    if 'resample_branch' in stages:
+        mc_file = os.path.join(workdir, 'mc.root')
+        to_root(
+            pd.DataFrame(generate_mc(n, particle=particle)),
+            mc_file,
+            key='DecayTree')
+        task_config = os.path.join(workdir, 'config.json')
+        with open(task_config, 'w') as f:
+            json.dump({
+                'tasks': [{
+                    'resampler_path':
+                    os.path.join(workdir,
+                                 'Kaon_StrippingBench_MagnetUp.resamplers'),
+                    'features': [
+                        '{}_P'.format(particle), '{}_ETA'.format(particle),
+                        'nTracks'
+                    ],
+                    'pids': [{
+                        'kind': '{}_CombDLLK'.format(particle),
+                        'name': '{}_PIDK_corrected'.format(particle)
+                    }]
+                }]
+            }, f)
+        options = pidtool.parser.parse_args([
+            'resample_branch', task_config, mc_file, '--tree', 'DecayTree',
+            '--friend-file', '{stem}_pid.root'
+        ])
+        results['resample_branch'] = measure(lambda: options.func(options),
+                                             n)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    '''
+    Returns a list of all stages whose throughput dropped by more than the
+    given fraction compared to the baseline results
+    '''
+    regressions = []
+    for key, stages in results.items():
+        for stage, result in stages.items():
+            old = baseline.get(key, {}).get(stage)
+            if not old or not old.get('events_per_second') or \
+                    not result.get('events_per_second'):
+                continue
+            ratio = result['events_per_second'] / old['events_per_second']
+            if ratio < 1 - tolerance:
+                regressions.append('{} {}: {:.3g} -> {:.3g} events/s'.format(
+                    key, stage, old['events_per_second'],
+                    result['events_per_second']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument(
+        '--events',
+        nargs='+',
+        type=int,
+        default=[100000, 1000000],
+        help='Event counts to benchmark. Default: 100000 1000000')
+    parser.add_argument(
+        '--schemes',
+        nargs='+',
+        default=['DLLKpi', 'highres'],
+        help='PIDCalib binning schemes to benchmark. Default: DLLKpi highres')
+    parser.add_argument(
+        '--stages',
+        nargs='+',
+        choices=STAGES,
+        default=STAGES,
+        help='Stages to benchmark. Default: all')
+    parser.add_argument('--output', help='Write the results to this file')
+    parser.add_argument(
+        '--compare',
+        help='Results of an earlier run. Exits with status 1 if the '
+        'throughput of a stage dropped by more than --tolerance.')
+    parser.add_argument(
+        '--tolerance',
+        type=float,
+        default=0.2,
+        help='Allowed relative drop of the throughput. Default: 0.2')
+    options = parser.parse_args(argv)
+
+    logging.getLogger().setLevel(logging.WARNING)
+    file_stages = [
+        s for s in options.stages
+        if s in ('create_resamplers', 'resample_branch')
+    ]
+
+    results = {}
+    for scheme in options.schemes:
+        for n in options.events:
+            key = '{}/{}'.format(scheme, n)
+            print('Running {}'.format(key), file=sys.stderr)
+            results[key] = bench_in_memory(n, scheme, options.stages)
+            if file_stages:
+                workdir = tempfile.mkdtemp(prefix='pid_benchmark_')
+                try:
+                    results[key].update(
+                        bench_files(n, scheme, file_stages, workdir))
+                finally:
+                    shutil.rmtree(workdir)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, options.tolerance)
+        for regression in regressions:
+            print('Regression: ' + regression, file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
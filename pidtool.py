@@ -3,10 +3,9 @@
 from __future__ import print_function
 import argparse
 import numpy as np
-from numpy.random import choice
 import logging
 import json
-from TrafoProbNN import back_transform
+from TrafoProbNN import back_transform, transform
 import ROOT as R
 
 logging.basicConfig(level=logging.INFO)
@@ -25,7 +24,7 @@ class Resampler:
             edges.append(args[-1])
             self.edges = edges
 
-            self.histogram = np.zeros(map(lambda x: len(x) - 1, self.edges))
+            self.histogram = np.zeros([len(x) - 1 for x in self.edges])
 
     def copy(self):
         '''
@@ -37,34 +36,78 @@ class Resampler:
         return rv
 
     def learn(self, features, weights=None):
+        '''
+        Adds a chunk of events to the histogram. `features` holds one array
+        (or column view) per axis. The flat bin indices of the events are
+        accumulated directly into the histogram, which gives the same result
+        as np.histogramdd without allocating a full-size histogram per chunk.
+        '''
         assert (len(features) == len(self.edges))
+        flat = np.zeros(len(features[0]), dtype=np.int64)
+        valid = np.ones(len(flat), dtype=bool)
+        for edges, vals in zip(self.edges, features):
+            idx = _axis_bins(edges, vals)
+            valid &= idx >= 0
+            flat *= len(edges) - 1
+            flat += idx
+        if weights is not None:
+            weights = np.asarray(weights, dtype=float)[valid]
+        self.fill_bins(flat[valid], weights)
+
+    def fill_bins(self, flat, weights=None):
+        '''
+        Adds the (optional) weights of events in the bins with the given flat
+        indices to the histogram
+        '''
+        hist = self.histogram.reshape(-1)
+        if len(flat) >= len(hist):
+            hist += np.bincount(flat, weights=weights, minlength=len(hist))
+        else:
+            # Sum up the events per filled bin and only update those bins,
+            # instead of creating a temporary of the size of the histogram
+            filled, inverse = np.unique(flat, return_inverse=True)
+            hist[filled] += np.bincount(inverse.ravel(), weights=weights)
 
-        features = np.array(features)
+    def nonzero_bins(self):
+        '''
+        Returns the flat indices and contents of all non-zero bins
+        '''
+        hist = self.histogram.reshape(-1)
+        idx = np.flatnonzero(hist)
+        return idx, hist[idx]
 
-        h, _ = np.histogramdd(features.T, bins=self.edges, weights=weights)
-        self.histogram += h
+    def add_bins(self, idx, values):
+        '''
+        Adds values to the bins with the given (unique) flat indices
+        '''
+        self.histogram.reshape(-1)[idx] += values
 
-    def sample(self, features):
+    def merge(self, other):
+        '''
+        Adds the histogram of another resampler with the same binning
+        '''
+        self.add_bins(*other.nonzero_bins())
+
+    def sample(self, features, uniforms=None):
+        '''
+        Samples one value per event. `uniforms` optionally holds two uniform
+        random numbers in [0, 1) per event (shape (2, n)), by default they are
+        drawn from numpy.random.
+        '''
 
         assert (len(features) == len(self.edges) - 1)
         args = np.array(features)
-        idx = [
+        idx = tuple(
             np.searchsorted(edges, vals) - 1
-            for edges, vals in zip(self.edges, args)
-        ]
+            for edges, vals in zip(self.edges, args))
         tmp = self.histogram[idx]
         # Fix negative bins (resulting from possible negative weights) to zero
         tmp[tmp < 0] = 0
-        norm = np.sum(tmp, axis=1)
-        probs = tmp / norm[:, np.newaxis]
-        sampled_bin = []
-        for i in range(tmp.shape[0]):
-            sampled_bin.append(choice(tmp.shape[1], p=probs[i, :]))
-        sampled_bin = np.array(sampled_bin)
-        sampled_val = np.random.uniform(
-            self.edges[-1][sampled_bin],
-            self.edges[-1][sampled_bin + 1],
-            size=len(sampled_bin))
+        cdf, norm = _normalized_cdf(tmp)
+        uniforms = _uniforms(uniforms, len(cdf))
+        sampled_bin = _draw_bins(cdf, np.arange(len(cdf)), uniforms[0])
+        sampled_val = _uniform_in_bins(self.edges[-1], sampled_bin,
+                                       uniforms[1])
         # If the histogram is empty, we can't sample
         sampled_val[norm == 0] = -1000
 
@@ -74,15 +117,533 @@ class Resampler:
                 len(features[0]), len(sampled_val)))
         return sampled_val
 
+    def freeze(self):
+        '''
+        Returns an immutable, sampling-only FrozenResampler with the
+        normalized cumulative tables precomputed
+        '''
+        return FrozenResampler.from_histogram(self.edges, self.histogram)
 
-def rooBinning_to_list(rooBinning):
-    return [rooBinning.binLow(i) for i in range(rooBinning.numBins())
-            ] + [rooBinning.binHigh(rooBinning.numBins() - 1)]
+
+class SparseResampler:
+    '''
+    Resampler that only stores occupied bins. The histogram is kept as the
+    sorted flat indices of all filled bins and their contents, which makes
+    fine binnings usable where the dense histogram would not fit into memory.
+    Bins added by `add_bins` are buffered and merged into the sorted arrays
+    at once, when the buffer holds as many entries as the merged arrays (but
+    at least `merge_threshold`) or when the bins are accessed. Filling
+    therefore does not slow down with the number of chunks.
+    '''
+    merge_threshold = 1000000
+
+    def __init__(self, *args):
+        self._keys = np.zeros(0, dtype=np.int64)
+        self._values = np.zeros(0)
+        self._pending = []
+        self._n_pending = 0
+        if args:
+            edges = []
+            for arg in args[:-1]:
+                edges.append(np.append(np.append([-np.inf], arg), [np.inf]))
+            edges.append(np.asarray(args[-1], dtype=float))
+            self.edges = edges
+            self.shape = tuple(len(x) - 1 for x in self.edges)
+
+    @property
+    def keys(self):
+        self._merge_pending()
+        return self._keys
+
+    @property
+    def values(self):
+        self._merge_pending()
+        return self._values
+
+    def __getstate__(self):
+        # Pickles hold the merged bins as `keys` and `values`
+        self._merge_pending()
+        state = dict(self.__dict__)
+        state['keys'] = state.pop('_keys')
+        state['values'] = state.pop('_values')
+        del state['_pending'], state['_n_pending']
+        return state
+
+    def __setstate__(self, state):
+        state = dict(state)
+        self._keys = state.pop('keys')
+        self._values = state.pop('values')
+        self._pending = []
+        self._n_pending = 0
+        self.__dict__.update(state)
+
+    def copy(self):
+        '''
+        Creates a copy of the resampler
+        '''
+        rv = SparseResampler()
+        rv.edges = list(self.edges)
+        rv.shape = self.shape
+        rv._keys = self.keys.copy()
+        rv._values = self.values.copy()
+        return rv
+
+    def learn(self, features, weights=None):
+        assert (len(features) == len(self.edges))
+        idx = [_axis_bins(edges, vals) for edges, vals in zip(self.edges,
+                                                               features)]
+        valid = np.all([i >= 0 for i in idx], axis=0)
+        flat = np.ravel_multi_index([i[valid].astype(np.int64) for i in idx],
+                                    self.shape)
+        if weights is not None:
+            weights = np.asarray(weights, dtype=float)[valid]
+        self.fill_bins(flat, weights)
+
+    def fill_bins(self, flat, weights=None):
+        keys, inverse = np.unique(flat, return_inverse=True)
+        self.add_bins(keys, np.bincount(inverse, weights=weights,
+                                        minlength=len(keys)))
+
+    def nonzero_bins(self):
+        nonzero = self.values != 0
+        return self.keys[nonzero], self.values[nonzero]
+
+    def add_bins(self, idx, values):
+        self._pending.append((np.asarray(idx, dtype=np.int64),
+                              np.asarray(values, dtype=float)))
+        self._n_pending += len(self._pending[-1][0])
+        if self._n_pending >= max(len(self._keys), self.merge_threshold):
+            self._merge_pending()
+
+    def _merge_pending(self):
+        '''
+        Merges the buffered bins into the sorted keys and values. The
+        contents of every bin are summed in the order in which they were
+        added.
+        '''
+        if not self._pending:
+            return
+        keys, inverse = np.unique(
+            np.concatenate([self._keys] + [k for k, _ in self._pending]),
+            return_inverse=True)
+        self._values = np.bincount(
+            inverse.ravel(),
+            weights=np.concatenate([self._values] +
+                                   [v for _, v in self._pending]),
+            minlength=len(keys))
+        self._keys = keys
+        self._pending = []
+        self._n_pending = 0
+
+    def merge(self, other):
+        '''
+        Adds the histogram of another resampler with the same binning
+        '''
+        self.add_bins(*other.nonzero_bins())
+
+    def sample(self, features, uniforms=None):
+        return self.freeze().sample(features, uniforms)
+
+    def freeze(self):
+        return FrozenSparseResampler.from_bins(self.edges, self.keys,
+                                               self.values)
+
+
+class ResamplerBank:
+    '''
+    Fills several resamplers that share the same kinematic binning from one
+    set of kinematic features. The kinematic bin of every event is computed
+    once per chunk and reused for the target axis of every pid, instead of
+    running np.histogramdd once per pid. The result is identical to calling
+    `learn` on every resampler.
+    '''
+
+    def __init__(self, resamplers):
+        self.resamplers = resamplers
+        edges = [r.edges[:-1] for r in resamplers.values()]
+        self.edges = edges[0]
+        for other in edges[1:]:
+            assert all(np.array_equal(a, b) for a, b in zip(self.edges, other))
+        self.shape = tuple(len(e) - 1 for e in self.edges)
+
+    def learn(self, features, targets, weights=None):
+        '''
+        `features` holds one array per kinematic variable, `targets` maps
+        every pid to the array of its values
+        '''
+        assert (len(features) == len(self.edges))
+        idx = [_axis_bins(edges, vals) for edges, vals in zip(self.edges,
+                                                               features)]
+        valid = np.all([i >= 0 for i in idx], axis=0)
+        cells = np.zeros(len(valid), dtype=np.int64)
+        cells[valid] = np.ravel_multi_index([i[valid] for i in idx],
+                                            self.shape)
+        if weights is not None:
+            weights = np.asarray(weights, dtype=float)
+
+        for pid, values in targets.items():
+            resampler = self.resamplers[pid]
+            target_edges = resampler.edges[-1]
+            n_target = len(target_edges) - 1
+            target = _axis_bins(target_edges, values)
+            selected = valid & (target >= 0)
+            resampler.fill_bins(
+                cells[selected] * n_target + target[selected],
+                None if weights is None else weights[selected])
+
+
+def _axis_bins(edges, values):
+    '''
+    Returns the bin of every value along one axis with the conventions of
+    np.histogramdd (the last bin includes its upper edge) and -1 for values
+    outside of the edges
+    '''
+    values = np.asarray(values)
+    idx = np.searchsorted(edges, values, side='right')
+    idx[values == edges[-1]] -= 1
+    idx -= 1
+    idx[idx >= len(edges) - 1] = -1
+    return idx
+
+
+class FrozenResampler:
+    '''
+    Sampling-only version of a Resampler. Negative bins are clamped and the
+    target axis is turned into cumulative distributions once, so sampling
+    only has to look up bins. The tables are stored as one flat contiguous
+    array with one row of `shape[-1]` entries per kinematic cell.
+    '''
+
+    def __init__(self, edges, cdf, norm):
+        self.edges = [np.asarray(e, dtype=float) for e in edges]
+        self.shape = tuple(len(e) - 1 for e in self.edges)
+        self.cdf = np.ascontiguousarray(cdf, dtype=float).ravel()
+        self.norm = np.ascontiguousarray(norm, dtype=float).ravel()
+        assert len(self.cdf) == int(np.prod(self.shape))
+        assert len(self.norm) == len(self.cdf) // self.shape[-1]
+        for arr in self.edges + [self.cdf, self.norm]:
+            arr.flags.writeable = False
+
+    @classmethod
+    def from_histogram(cls, edges, histogram):
+        hist = np.array(histogram, dtype=float)
+        hist = hist.reshape(-1, hist.shape[-1])
+        # Fix negative bins (resulting from possible negative weights) to zero
+        hist[hist < 0] = 0
+        cdf, norm = _normalized_cdf(hist)
+        return cls(edges, cdf, norm)
+
+    def freeze(self):
+        return self
+
+    def to_arrays(self):
+        '''
+        Returns all tables as a dict of arrays, see ResamplerStore
+        '''
+        arrays = {'cdf': self.cdf, 'norm': self.norm}
+        for i, edges in enumerate(self.edges):
+            arrays['edges_{}'.format(i)] = edges
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        n_dims = sum(1 for name in arrays if name.startswith('edges_'))
+        edges = [arrays['edges_{}'.format(i)] for i in range(n_dims)]
+        return cls(edges, arrays['cdf'], arrays['norm'])
+
+    def sample(self, features, uniforms=None):
+        assert (len(features) == len(self.edges) - 1)
+        cells = _kinematic_cells(self.edges, features)
+        uniforms = _uniforms(uniforms, len(cells))
+        sampled_bin = _draw_bins(
+            self.cdf.reshape(-1, self.shape[-1]), cells, uniforms[0])
+        sampled_val = _uniform_in_bins(self.edges[-1], sampled_bin,
+                                       uniforms[1])
+        # If the histogram is empty, we can't sample
+        sampled_val[self.norm[cells] == 0] = -1000
+        return sampled_val
+
+
+class FrozenSparseResampler:
+    '''
+    Sampling-only version of a SparseResampler. The occupied kinematic cells
+    are stored in CSR form: `cells` lists them in ascending order, the
+    entries of cell i are `indptr[i]:indptr[i + 1]` of `bins` (the target
+    bins with positive content) and `cdf` (their row-shifted cumulative
+    distribution, see `_normalized_cdf`).
+    '''
+
+    def __init__(self, edges, cells, indptr, bins, cdf, norm):
+        self.edges = [np.asarray(e, dtype=float) for e in edges]
+        self.shape = tuple(len(e) - 1 for e in self.edges)
+        self.cells = np.asarray(cells, dtype=np.int64)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.bins = np.asarray(bins, dtype=np.int64)
+        self.cdf = np.asarray(cdf, dtype=float)
+        self.norm = np.asarray(norm, dtype=float)
+        assert len(self.indptr) == len(self.cells) + 1
+        assert len(self.bins) == len(self.cdf) == self.indptr[-1]
+        for arr in self.edges + [self.cells, self.indptr, self.bins,
+                                 self.cdf, self.norm]:
+            arr.flags.writeable = False
+
+    @classmethod
+    def from_bins(cls, edges, keys, values):
+        n_target = len(edges[-1]) - 1
+        # Fix negative bins (resulting from possible negative weights) to zero
+        positive = values > 0
+        keys = keys[positive]
+        values = values[positive]
+        cells, rows, counts = np.unique(
+            keys // n_target, return_inverse=True, return_counts=True)
+        indptr = np.append([0], np.cumsum(counts))
+        norm = np.bincount(rows, weights=values, minlength=len(cells))
+        csum = np.cumsum(values)
+        cdf = (csum - (csum[indptr[1:] - 1] - norm)[rows]) / norm[rows]
+        cdf = np.minimum(cdf, 1)
+        cdf[indptr[1:] - 1] = 1
+        return cls(edges, cells, indptr, keys % n_target, cdf + rows, norm)
+
+    def freeze(self):
+        return self
+
+    def to_arrays(self):
+        arrays = {
+            'cells': self.cells,
+            'indptr': self.indptr,
+            'bins': self.bins,
+            'cdf': self.cdf,
+            'norm': self.norm
+        }
+        for i, edges in enumerate(self.edges):
+            arrays['edges_{}'.format(i)] = edges
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        n_dims = sum(1 for name in arrays if name.startswith('edges_'))
+        edges = [arrays['edges_{}'.format(i)] for i in range(n_dims)]
+        return cls(edges, arrays['cells'], arrays['indptr'], arrays['bins'],
+                   arrays['cdf'], arrays['norm'])
+
+    def sample(self, features, uniforms=None):
+        assert (len(features) == len(self.edges) - 1)
+        cells = _kinematic_cells(self.edges, features)
+        uniforms = _uniforms(uniforms, len(cells))
+        rows = np.minimum(np.searchsorted(self.cells, cells),
+                          max(len(self.cells) - 1, 0))
+        found = np.zeros(len(cells), dtype=bool)
+        if len(self.cells):
+            found = self.cells[rows] == cells
+        rows = rows[found]
+        uniforms = uniforms[:, found]
+        pos = np.searchsorted(self.cdf, rows + uniforms[0], side='right')
+        pos = np.clip(pos, self.indptr[rows], self.indptr[rows + 1] - 1)
+        sampled_bin = self.bins[pos]
+        # If the histogram is empty, we can't sample
+        sampled_val = np.full(len(cells), -1000.)
+        sampled_val[found] = _uniform_in_bins(self.edges[-1], sampled_bin,
+                                              uniforms[1])
+        return sampled_val
+
+
+def _uniforms(uniforms, n):
+    if uniforms is None:
+        return np.random.uniform(size=(2, n))
+    uniforms = np.asarray(uniforms)
+    assert uniforms.shape == (2, n)
+    return uniforms
+
+
+def _uniform_in_bins(edges, bins, uniforms):
+    '''
+    Maps uniforms in [0, 1) to values distributed uniformly within the bins
+    '''
+    low = edges[bins]
+    return low + uniforms * (edges[bins + 1] - low)
+
+
+def _mix64(x):
+    '''
+    SplitMix64 finalizer, maps uint64 arrays to well mixed uint64 arrays
+    '''
+    x = x + np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def counter_uniforms(seed, keys, stream, n_draws=2):
+    '''
+    Counter-based random numbers: returns `n_draws` uniforms in [0, 1) per
+    event that only depend on the seed, the stream (e.g. the output branch)
+    and the keys of the event (e.g. run and event number, or the entry
+    number). The result is therefore independent of how the events are
+    split into chunks or distributed over processes.
+    '''
+    # Any integer is a valid seed, only its lowest 64 bits are used
+    mask = 0xFFFFFFFFFFFFFFFF
+    h = _mix64(np.full(len(keys[0]), seed & mask, dtype=np.uint64))
+    h = _mix64(h ^ np.uint64(stream & mask))
+    for key in keys:
+        h = _mix64(h ^ np.asarray(key).astype(np.uint64))
+    uniforms = np.empty((n_draws, len(h)))
+    for i in range(n_draws):
+        draw = _mix64(h ^ np.uint64(i))
+        # use the upper 53 bits as mantissa of a double in [0, 1)
+        uniforms[i] = (draw >> np.uint64(11)) * 2.0**-53
+    return uniforms
+
+
+def branch_stream(name):
+    '''
+    Returns the random number stream of an output branch
+    '''
+    import zlib
+    return zlib.crc32(name.encode('utf-8')) & 0xffffffff
+
+
+def _kinematic_cells(edges, features):
+    '''
+    Returns the flat index of the kinematic cell of every event
+    '''
+    idx = tuple(
+        np.searchsorted(e, vals) - 1 for e, vals in zip(edges, features))
+    return np.ravel_multi_index(idx, [len(e) - 1 for e in edges[:-1]])
+
+
+def _normalized_cdf(hist):
+    '''
+    Turns rows of non-negative bin contents into cumulative distributions
+    shifted by their row number, i.e. row i runs from i to i + 1. Flattened,
+    the result is monotonic, so a single searchsorted call can draw bins for
+    all rows at once. Empty rows are filled with i + 1, the returned norm
+    can be used to find them.
+    '''
+    cdf = np.cumsum(hist, axis=1)
+    norm = cdf[:, -1].copy()
+    empty = norm == 0
+    cdf[~empty] /= norm[~empty, np.newaxis]
+    # Pin the end of every row (including trailing empty bins) to exactly one
+    # so that rounding can never leak draws into the next row
+    cdf[cdf >= cdf[:, -1:]] = 1
+    cdf[empty] = 1
+    cdf += np.arange(len(cdf))[:, np.newaxis]
+    return cdf, norm
+
+
+def _draw_bins(cdf, rows, uniforms):
+    '''
+    Draws one target bin per entry of `rows` from a row-shifted cumulative
+    table as returned by `_normalized_cdf`, using the given uniforms in
+    [0, 1).
+    '''
+    n_bins = cdf.shape[-1]
+    pos = np.searchsorted(cdf.ravel(), rows + uniforms, side='right')
+    return np.clip(pos - rows * n_bins, 0, n_bins - 1)
+
+
+class ResamplerStore:
+    '''
+    On-disk container for frozen resamplers. The store is a directory with an
+    `index.json` that lists the tables of every pid and one `.npy` file per
+    table. Tables are memory-mapped and only loaded when a pid is requested,
+    so opening a store is cheap no matter how many pids it holds.
+    '''
+    suffix = '.resamplers'
+    types = {
+        'FrozenResampler': FrozenResampler,
+        'FrozenSparseResampler': FrozenSparseResampler
+    }
+
+    def __init__(self, path):
+        import os
+        self.path = path
+        with open(os.path.join(path, 'index.json')) as f:
+            self.index = json.load(f)['resamplers']
+        self._loaded = {}
+
+    def __contains__(self, kind):
+        return kind in self.index
+
+    def keys(self):
+        return self.index.keys()
+
+    def __getitem__(self, kind):
+        import os
+        if kind not in self._loaded:
+            entry = self.index[kind]
+            arrays = {
+                name: np.load(os.path.join(self.path, filename),
+                              mmap_mode='r')
+                for name, filename in entry['arrays'].items()
+            }
+            self._loaded[kind] = self.types[entry['type']].from_arrays(arrays)
+        return self._loaded[kind]
+
+    @classmethod
+    def save(cls, path, resamplers):
+        '''
+        Freezes all resamplers and writes them to a new store at `path`
+        '''
+        import os
+        os.makedirs(path)
+        index = {}
+        for kind, resampler in resamplers.items():
+            resampler = resampler.freeze()
+            files = {}
+            for name, arr in resampler.to_arrays().items():
+                files[name] = '{}.{}.npy'.format(kind, name)
+                np.save(os.path.join(path, files[name]), arr)
+            index[kind] = {
+                'type': type(resampler).__name__,
+                'arrays': files
+            }
+        # Write the index last, a store without one is incomplete
+        with open(os.path.join(path, 'index.json'), 'w') as f:
+            json.dump({'resamplers': index}, f, indent=2, sort_keys=True)
+
+
+# Resampler files and frozen resamplers that have been loaded in this run
+_resampler_files = {}
+_frozen_resamplers = {}
+
+
+def open_resampler_file(path):
+    '''
+    Opens a resampler pickle or ResamplerStore. Every file is only opened once
+    per run, later calls return the already loaded object.
+    '''
+    import os
+    import pickle
+    key = os.path.realpath(path)
+    if key not in _resampler_files:
+        if os.path.isdir(path):
+            _resampler_files[key] = ResamplerStore(path)
+        else:
+            with open(path, 'rb') as f:
+                try:
+                    _resampler_files[key] = pickle.load(f)
+                except UnicodeDecodeError:  # pickled with python2
+                    f.seek(0)
+                    _resampler_files[key] = pickle.load(f, encoding='latin1')
+    return _resampler_files[key]
+
+
+def load_resampler(path, kind):
+    '''
+    Returns the frozen resampler for `kind` from the file at `path`
+    '''
+    import os
+    key = (os.path.realpath(path), kind)
+    if key not in _frozen_resamplers:
+        _frozen_resamplers[key] = open_resampler_file(path)[kind].freeze()
+    return _frozen_resamplers[key]
 
 
 def grab_data(options):
-    import ROOT
-    from ROOT import TFile
+    import multiprocessing as mp
+    import os
     from os.path import join, exists
     from os import makedirs
 
@@ -99,34 +660,208 @@ def grab_data(options):
             if sample['particle'] in options.particles
         ]
 
+    # Every input file is converted into its own part file first. The
+    # manifest records the finished ones, so a rerun after a failure only
+    # converts the inputs that are still missing. Once a sample is combined,
+    # its part files are removed and the manifest records which inputs the
+    # combined file holds.
+    manifest_path = join(options.output, 'manifest.json')
+    manifest = _load_manifest(manifest_path)
+
+    jobs = []
+    for sample in locations:
+        name = _sample_name(sample)
+        if not _is_assembled(sample, manifest, options.output):
+            # The inputs in an outdated combined file have to be grabbed
+            # again, their part files are gone
+            for entry in manifest.values():
+                if entry.get('sample') == name + '.root':
+                    del entry['sample']
+                    del entry['sample_size']
+        for i, input_file in enumerate(sample['paths']):
+            part = join('parts', name, '{}_{}'.format(
+                i, input_file.split('/')[-1]))
+            if _is_grabbed(manifest.get(input_file), options.output):
+                logging.info('Skipping {}, already grabbed'.format(
+                    input_file))
+                continue
+            jobs.append((input_file, options.output, part))
+
+    logging.info('Grabbing {} input files'.format(len(jobs)))
+    if options.jobs > 1:
+        # Every conversion runs in a fresh process, a crash while cleaning up
+        # ROOT then does not affect the other inputs
+        pool = mp.Pool(processes=options.jobs, maxtasksperchild=1)
+        results = pool.imap_unordered(_grab_input, jobs)
+    else:
+        pool = None
+        results = (_grab_input(job) for job in jobs)
+    try:
+        for input_file, entry in results:
+            manifest[input_file] = entry
+            _save_manifest(manifest_path, manifest)
+            logging.info('Finished {}'.format(input_file))
+    finally:
+        if pool is not None:
+            pool.terminate()
+
     for sample in locations:
-        output = join(
-            options.output,
-            '{particle}_Stripping{stripping}_Magnet{magnet}.root'.format(
-                **sample))
-        ff = TFile(output, 'recreate')
-        ff.Close()
-        for input_file in sample['paths']:
-            logging.info('Opening file {}'.format(input_file))
-
-            f = TFile(input_file)
-            ws = f.Get(f.GetListOfKeys().First().GetName())
-            ROOT.SetOwnership(ws, False)
-            data = ws.allData().front()
-            ROOT.RooAbsData.setDefaultStorageType(ROOT.RooAbsData.Tree)
-            ff = TFile(output, 'update')
-            dset = ROOT.RooDataSet('tree', 'tree',
-                                   data.get(), ROOT.RooFit.Import(data))
-            logging.info('Saving data to {}'.format(output))
-            dset.tree().Write('tree')
-            ff.Close()
-            ws.Delete()
+        name = _sample_name(sample) + '.root'
+        output = join(options.output, name)
+        entries = [manifest[input_file] for input_file in sample['paths']]
+        new = [entry for entry in entries if 'sample' not in entry]
+        if not new:
+            logging.info('{} is up to date'.format(output))
+            continue
+        # New inputs are appended to the inputs that are already combined
+        sources = [join(options.output, entry['part']) for entry in new]
+        if len(new) < len(entries):
+            sources.insert(0, output)
+        logging.info('Saving data to {}'.format(output))
+        _assemble_parts(output, sources)
+        size = os.path.getsize(output)
+        for entry in entries:
+            entry['sample'] = name
+            entry['sample_size'] = size
+        _save_manifest(manifest_path, manifest)
+        for entry in new:
+            os.remove(join(options.output, entry['part']))
+        parts_dir = join(options.output, 'parts', _sample_name(sample))
+        if os.path.isdir(parts_dir) and not os.listdir(parts_dir):
+            os.rmdir(parts_dir)
+
+
+def _sample_name(sample):
+    return '{particle}_Stripping{stripping}_Magnet{magnet}'.format(**sample)
+
+
+def _load_manifest(path):
+    import os
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _save_manifest(path, manifest):
+    import os
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.rename(path + '.tmp', path)
+
+
+def _input_size(input_file, tfile=None):
+    import os
+    if os.path.exists(input_file):
+        return os.path.getsize(input_file)
+    if tfile is not None:
+        return tfile.GetSize()
+    return None
+
+
+def _input_changed(entry):
+    size = _input_size(entry['input'])
+    return size is not None and size != entry['input_size']
+
+
+def _is_grabbed(entry, output):
+    '''
+    Checks whether the input of a manifest entry is already combined into
+    its sample or its part file is complete and, for local inputs, whether
+    the input has changed since
+    '''
+    import os
+    if entry is None or _input_changed(entry):
+        return False
+    if 'sample' in entry:
+        return True
+    part = os.path.join(output, entry['part'])
+    return os.path.exists(part) and \
+        os.path.getsize(part) == entry['part_size']
+
+
+def _is_assembled(sample, manifest, output):
+    '''
+    Checks whether the combined file of a sample still matches the inputs
+    that the manifest records for it: the file has the recorded size, and
+    all of these inputs are still part of the sample and unchanged
+    '''
+    import os
+    name = _sample_name(sample) + '.root'
+    path = os.path.join(output, name)
+    assembled = [e for e in manifest.values() if e.get('sample') == name]
+    if not assembled or not os.path.exists(path):
+        return False
+    return all(
+        e['input'] in sample['paths'] and not _input_changed(e) and
+        e['sample_size'] == os.path.getsize(path) for e in assembled)
+
+
+def _grab_input(args):
+    '''
+    Converts the RooDataSet of one input file (EOS URL or local path) into
+    a tree in its part file and returns the manifest entry
+    '''
+    import os
+    import ROOT
+    from ROOT import TFile
+    input_file, output, part = args
+    part_path = os.path.join(output, part)
+    if not os.path.exists(os.path.dirname(part_path)):
+        try:
+            os.makedirs(os.path.dirname(part_path))
+        except OSError:  # created by another worker in the meantime
+            pass
+
+    logging.info('Opening file {}'.format(input_file))
+    f = TFile(input_file)
+    input_size = _input_size(input_file, f)
+    ws = f.Get(f.GetListOfKeys().First().GetName())
+    ROOT.SetOwnership(ws, False)
+    data = ws.allData().front()
+    ROOT.RooAbsData.setDefaultStorageType(ROOT.RooAbsData.Tree)
+    # Write to a temporary file first, so that an interrupted conversion
+    # never leaves a part file behind that looks complete
+    ff = TFile(part_path + '.tmp', 'recreate')
+    dset = ROOT.RooDataSet('tree', 'tree', data.get(), ROOT.RooFit.Import(data))
+    entries = dset.numEntries()
+    dset.tree().Write('tree')
+    ff.Close()
+    ws.Delete()
+    f.Close()
+    os.rename(part_path + '.tmp', part_path)
+    return input_file, {
+        'input': input_file,
+        'input_size': input_size,
+        'part': part,
+        'part_size': os.path.getsize(part_path),
+        'entries': entries
+    }
+
+
+def _assemble_parts(output, sources):
+    '''
+    Chains the trees of all source files and writes them into `output` as a
+    single tree. The result is written to a temporary file first, which is
+    then renamed, so `output` itself may be one of the sources.
+    '''
+    import os
+    from ROOT import TChain, TFile, TObject
+    chain = TChain('tree')
+    for source in sources:
+        chain.Add(source, -1)
+    ff = TFile(output + '.tmp', 'recreate')
+    tree = chain.CloneTree(-1, 'fast')
+    tree.Write('tree', TObject.kOverwrite)
+    ff.Close()
+    del chain
+    os.rename(output + '.tmp', output)
 
 
 def create_resamplers(options):
     import os
     import pickle
-    from root_pandas import read_root
+    import shutil
     from PIDPerfScripts.Binning import GetBinScheme
 
     # TupleToolANNPID stores all available tunes whereas TupleToolPid stores
@@ -191,18 +926,15 @@ def create_resamplers(options):
         locations = [
             sample for sample in locations if sample['magnet'] == 'Up'
         ]
+    resampler_type = SparseResampler if options.sparse else Resampler
     for sample in locations:
         # last argument takes name of user-defined binning
-        binning_P = rooBinning_to_list(
-            GetBinScheme(sample['branch_particle'], 'P', None))
-        # last argument takes name of user-defined binning
-        # TODO: let user pass this argument
-        binning_ETA = rooBinning_to_list(
-            GetBinScheme(sample['branch_particle'], 'ETA', None))
-        # last argument takes name of user-defined binning
-        # TODO: let user pass this argument
-        binning_nTracks = rooBinning_to_list(
-            GetBinScheme(sample['branch_particle'], 'nTracks', None))
+        binning_P = GetBinScheme(sample['branch_particle'], 'P',
+                                 options.binning_scheme)
+        binning_ETA = GetBinScheme(sample['branch_particle'], 'ETA',
+                                   options.binning_scheme)
+        binning_nTracks = GetBinScheme(sample['branch_particle'], 'nTracks',
+                                       options.binning_scheme)
         if options.both_magnet_orientations:
             if sample['magnet'] == 'Up':
                 data = [
@@ -229,13 +961,16 @@ def create_resamplers(options):
                 '/{particle}_Stripping{stripping}_Magnet{magnet}.pkl'.format(
                     **sample
                 )
-        if os.path.exists(resampler_location):
+        if options.format == 'store':
+            resampler_location = resampler_location[:-len('.pkl')] + \
+                ResamplerStore.suffix
+            if os.path.exists(resampler_location):
+                shutil.rmtree(resampler_location)
+        elif os.path.exists(resampler_location):
             os.remove(resampler_location)
         resamplers = dict()
-        deps = map(lambda x: x.format(sample['branch_particle']),
-                   kin_variables)
-        pids = map(lambda x: x.format(sample['branch_particle']),
-                   pid_variables)
+        deps = [x.format(sample['branch_particle']) for x in kin_variables]
+        pids = [x.format(sample['branch_particle']) for x in pid_variables]
         for pid in pids:
             if 'DLL' in pid:
                 # binning for DLL
@@ -248,46 +983,615 @@ def create_resamplers(options):
                 target_binning = np.linspace(0, 1, 100)
             else:
                 raise Exception
-            resamplers[pid] = Resampler(binning_P, binning_ETA,
-                                        binning_nTracks, target_binning)
-
-        for dataSet in data:
+            resamplers[pid] = resampler_type(binning_P, binning_ETA,
+                                             binning_nTracks, target_binning)
+
+        if options.adaptive_binning:
+            kin_binning, target_binnings = adaptive_binning(
+                data, deps, pids, resamplers, options)
+            resamplers = {
+                pid: resampler_type(*(kin_binning + [target_binnings[pid]]))
+                for pid in pids
+            }
+
+        if options.cache:
+            empty = {pid: r.copy() for pid, r in resamplers.items()}
+            for dataSet in data:
+                partials = cached_partials(empty, dataSet, deps, pids,
+                                           options)
+                for pid, (idx, values) in partials.items():
+                    resamplers[pid].add_bins(idx, values)
+        else:
+            learn_files(resamplers, data, deps, pids, options)
+        if options.freeze:
+            resamplers = {
+                pid: resampler.freeze()
+                for pid, resampler in resamplers.items()
+            }
+        if options.format == 'store':
+            ResamplerStore.save(resampler_location, resamplers)
+        else:
+            with open(resampler_location, 'wb') as f:
+                pickle.dump(resamplers, f)
+
+
+def learn_files(resamplers, data, deps, pids, options):
+    '''
+    Fills the resamplers from the calibration files in `data`
+    '''
+    if options.num_cpu > 1:
+        learn_parallel(resamplers, data, options.tree, deps, pids,
+                       options.cutstring, options.num_cpu)
+        return
+    for dataSet in data:
+        for i, (start, stop) in enumerate(
+                _entry_ranges(dataSet, options.tree, LEARN_CHUNKSIZE)):
             # where is None if option is not set
-            for i, chunk in enumerate(
-                    read_root(
-                        dataSet,
-                        options.tree,
-                        columns=deps + pids + ['nsig_sw'],
-                        chunksize=100000,
-                        where=options.cutstring)):
-                for pid in pids:
-                    resamplers[pid].learn(
-                        chunk[deps + [pid]].values.T, weights=chunk['nsig_sw'])
-                logging.info('Finished chunk {}'.format(i))
-        with open(resampler_location, 'wb') as f:
-            pickle.dump(resamplers, f)
+            chunk = read_calibration(
+                dataSet,
+                options.tree,
+                columns=learn_columns(deps, pids),
+                where=options.cutstring,
+                start=start,
+                stop=stop)
+            learn_chunk(resamplers, chunk, deps, pids)
+            logging.info('Finished chunk {}'.format(i))
+
+
+def tree_cycles(path, tree=None):
+    '''
+    Returns the name of the tree in the file at `path` and the names of all
+    its cycles. grab_data used to write every input file as a new cycle of
+    the same tree, so all cycles hold calibration data (as in
+    TrafoProbNN.open_input_tree).
+    '''
+    f = R.TFile.Open(path)
+    if not f or f.IsZombie():
+        raise IOError('Could not open {}'.format(path))
+    keys = [(key.GetName(), key.GetCycle()) for key in f.GetListOfKeys()
+            if R.TClass.GetClass(key.GetClassName()).InheritsFrom('TTree')]
+    f.Close()
+    if not tree:
+        names = sorted(set(name for name, _ in keys))
+        if len(names) != 1:
+            raise ValueError('More than one tree found in {}'.format(path))
+        tree = names[0]
+    cycles = sorted(cycle for name, cycle in keys if name == tree)
+    if len(cycles) <= 1:
+        # A single tree, possibly in a subdirectory
+        return tree, [tree]
+    return tree, ['{};{}'.format(tree, cycle) for cycle in cycles]
+
+
+def calibration_chain(path, tree=None):
+    '''
+    Returns a chain of all cycles of the calibration tree in `path`
+    '''
+    tree, cycles = tree_cycles(path, tree)
+    chain = R.TChain(tree)
+    for cycle in cycles:
+        chain.Add('{}/{}'.format(path, cycle), -1)
+    return chain
+
+
+def read_calibration(path, tree, columns, where=None, start=None,
+                     stop=None, step=None):
+    '''
+    Reads the given columns of the entries [start, stop) of all cycles of
+    the calibration tree in `path` into a DataFrame
+    '''
+    from pandas import DataFrame
+    from root_numpy import tree2array
+    return DataFrame(
+        tree2array(
+            calibration_chain(path, tree),
+            branches=columns,
+            selection=where,
+            start=start,
+            stop=stop,
+            step=step))
+
+
+def cached_partials(resamplers, path, deps, pids, options):
+    '''
+    Returns the non-zero bins that the calibration file at `path` adds to
+    each of the (empty) resamplers. Results are cached in `options.cache`,
+    keyed by the identity of the file (path, size, modification time), the
+    cutstring, the tree and the binning of every resampler, so only new or
+    changed files are read again.
+    '''
+    import os
+    import pickle
+    import hashlib
+    stat = os.stat(path)
+    key = {
+        'path': os.path.realpath(path),
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'cutstring': options.cutstring,
+        'tree': options.tree,
+        'binning': {
+            pid: [type(resamplers[pid]).__name__] +
+            [list(map(float, e)) for e in resamplers[pid].edges]
+            for pid in pids
+        }
+    }
+    digest = hashlib.sha1(
+        json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+    cache_file = os.path.join(options.cache, digest + '.pkl')
+    if os.path.exists(cache_file):
+        logging.info('Using cached histograms for {}'.format(path))
+        with open(cache_file, 'rb') as f:
+            return pickle.load(f)
+
+    partial = {pid: resamplers[pid].copy() for pid in pids}
+    learn_files(partial, [path], deps, pids, options)
+    partials = {pid: partial[pid].nonzero_bins() for pid in pids}
+    if not os.path.exists(options.cache):
+        os.makedirs(options.cache)
+    with open(cache_file + '.tmp', 'wb') as f:
+        pickle.dump(partials, f, protocol=2)
+    os.rename(cache_file + '.tmp', cache_file)
+    return partials
+
+
+# Number of calibration entries that are read and learned at once
+LEARN_CHUNKSIZE = 100000
+
+
+TRAFO_SUFFIX = '_Trafo'
+
+
+def learn_columns(deps, pids):
+    '''
+    Returns the columns that have to be read to learn the given pids. The
+    transformed ProbNN variables are computed from the raw ones on the fly.
+    '''
+    columns = list(deps)
+    for pid in pids:
+        if pid.endswith(TRAFO_SUFFIX):
+            pid = pid[:-len(TRAFO_SUFFIX)]
+        if pid not in columns:
+            columns.append(pid)
+    return columns + ['nsig_sw']
+
+
+def learn_targets(chunk, pids):
+    '''
+    Returns the values of all pids in the chunk
+    '''
+    targets = {}
+    for pid in pids:
+        if pid.endswith(TRAFO_SUFFIX):
+            # log(x/(1-x)) transformation as done by TrafoProbNN.py
+            targets[pid], _ = transform(
+                chunk[pid[:-len(TRAFO_SUFFIX)]].values)
+        else:
+            targets[pid] = chunk[pid].values
+    return targets
+
+
+def learn_chunk(resamplers, chunk, deps, pids):
+    bank = ResamplerBank({pid: resamplers[pid] for pid in pids})
+    bank.learn(
+        [chunk[dep].values for dep in deps],
+        learn_targets(chunk, pids),
+        weights=chunk['nsig_sw'].values)
+
+
+def weighted_quantile_edges(values, weights, n_bins, lo=-np.inf, hi=np.inf):
+    '''
+    Returns at most `n_bins` + 1 bin edges, placed such that all bins contain
+    about the same sum of weights. Negative weights are ignored when placing
+    the edges. Finite `lo` and `hi` are used as the outer edges, otherwise
+    the smallest and largest value are.
+    '''
+    values = np.asarray(values, dtype=float)
+    weights = np.clip(np.asarray(weights, dtype=float), 0, None)
+    selected = np.isfinite(values) & (values >= lo) & (values <= hi) & \
+        (weights > 0)
+    values = values[selected]
+    order = np.argsort(values, kind='stable')
+    values = values[order]
+    cumulative = np.cumsum(weights[selected][order])
+    if len(values) == 0:
+        return np.array([lo, hi], dtype=float) \
+            if np.isfinite([lo, hi]).all() else \
+            np.array([0., 1.])
+    quantiles = np.linspace(0, cumulative[-1], n_bins + 1)[1:-1]
+    inner = values[np.minimum(
+        np.searchsorted(cumulative, quantiles), len(values) - 1)]
+    first = lo if np.isfinite(lo) else values[0]
+    last = hi if np.isfinite(hi) else values[-1]
+    edges = np.unique(np.concatenate([[first], inner, [last]]))
+    if len(edges) < 2:
+        edges = np.array([edges[0], edges[0] + 1])
+    return edges
+
+
+def adaptive_binning(data, deps, pids, resamplers, options):
+    '''
+    Derives the kinematic and target binning from weighted quantiles of a
+    sample of the calibration data. The sample takes every n-th entry of
+    every file, so it covers all runs. The number of kinematic cells is
+    chosen such that every cell contains about `options.target_occupancy`
+    (weighted) events, but all resamplers together do not need more than
+    `options.memory_budget` MB. As the quantiles are computed per axis,
+    correlations between the variables leave cells under-occupied, so the
+    number of bins is reduced until at most a fraction
+    ADAPTIVE_UNDERFILLED of the occupied cells holds fewer events than the
+    target. Empty cells are not counted.
+    The target axis of every pid keeps the range and number of bins of its
+    default binning in `resamplers`, but the edges follow the distribution
+    of the pid.
+    Returns the kinematic edges and a dict of the target edges by pid.
+    '''
+    columns = learn_columns(deps, pids)
+    per_file = max(1, options.adaptive_sample // len(data))
+    chunks = []
+    n_total = n_read = 0
+    for dataSet in data:
+        entries = calibration_chain(dataSet, options.tree).GetEntries()
+        step = max(1, entries // per_file)
+        n_total += entries
+        n_read += len(range(0, entries, step))
+        chunks.append(
+            read_calibration(
+                dataSet,
+                options.tree,
+                columns=columns,
+                where=options.cutstring,
+                step=step))
+    weights = np.concatenate([c['nsig_sw'].values for c in chunks])
+    # Scale the weights of the sample to the full data set
+    scale = float(n_total) / max(n_read, 1)
+    total_weight = np.clip(weights, 0, None).sum() * scale
+
+    n_dims = len(deps)
+    bytes_per_cell = 8 * sum(len(r.edges[-1]) - 1 for r in resamplers.values())
+    n_cells = min(total_weight / options.target_occupancy,
+                  options.memory_budget * 1024.**2 / bytes_per_cell)
+    n_bins = [max(1, int(n_cells**(1. / n_dims)))] * n_dims
+    # Under- and overflow bins are added to every kinematic axis
+    while np.prod([n + 2 for n in n_bins]) * bytes_per_cell > \
+            options.memory_budget * 1024.**2 and max(n_bins) > 1:
+        n_bins[int(np.argmax(n_bins))] -= 1
+
+    features = [np.concatenate([c[dep].values for c in chunks])
+                for dep in deps]
+    while True:
+        kin_binning = [
+            weighted_quantile_edges(values, weights, n)
+            for values, n in zip(features, n_bins)
+        ]
+        occupancy = _cell_occupancy(features, weights, kin_binning) * scale
+        occupied = occupancy[occupancy > 0]
+        underfilled = np.count_nonzero(occupied < options.target_occupancy)
+        if underfilled <= ADAPTIVE_UNDERFILLED * len(occupied) or \
+                max(n_bins) == 1:
+            break
+        n_bins[int(np.argmax(n_bins))] = int(max(n_bins) * 0.8)
+    logging.info(
+        'Adaptive kinematic binning with {} bins: {} of {} occupied cells '
+        'below the target occupancy, smallest occupied cell {:.0f}, median '
+        '{:.0f}, {} cells empty'.format(
+            [len(e) - 1 for e in kin_binning], underfilled, len(occupied),
+            occupied.min() if len(occupied) else 0.,
+            np.median(occupied) if len(occupied) else 0.,
+            len(occupancy) - len(occupied)))
+    kin_binning = [list(e) for e in kin_binning]
+
+    target_binnings = {}
+    targets = [learn_targets(c, pids) for c in chunks]
+    for pid in pids:
+        default = resamplers[pid].edges[-1]
+        target_binnings[pid] = weighted_quantile_edges(
+            np.concatenate([t[pid] for t in targets]),
+            weights,
+            len(default) - 1,
+            lo=default[0],
+            hi=default[-1])
+    return kin_binning, target_binnings
+
+
+# Fraction of the occupied kinematic cells that may hold fewer (weighted)
+# events than --target-occupancy in the adaptive binning
+ADAPTIVE_UNDERFILLED = 0.05
+
+
+def _cell_occupancy(features, weights, edges):
+    '''
+    Returns the sum of the positive weights in every cell of the binning
+    '''
+    idx = [_axis_bins(e, values) for e, values in zip(edges, features)]
+    valid = np.all([i >= 0 for i in idx], axis=0)
+    shape = tuple(len(e) - 1 for e in edges)
+    flat = np.ravel_multi_index([i[valid] for i in idx], shape)
+    return np.bincount(
+        flat,
+        weights=np.clip(weights, 0, None)[valid],
+        minlength=int(np.prod(shape)))
+
+
+def n_entries(path, tree=None):
+    '''
+    Returns the number of entries that read_root reads from the tree
+    '''
+    from root_numpy import list_trees
+    if not tree:
+        tree = list_trees(path)[0]
+    chain = R.TChain(tree)
+    chain.Add(path)
+    return chain.GetEntries()
+
+
+def _entry_ranges(path, tree, chunksize):
+    '''
+    Splits all cycles of the calibration tree into entry ranges of the
+    given chunksize
+    '''
+    total = calibration_chain(path, tree).GetEntries()
+    return [(start, min(start + chunksize, total))
+            for start in range(0, total, chunksize)]
+
+
+# Empty resamplers used as templates by the _learn_process workers
+_learn_templates = None
+
+
+def _init_learn_worker(templates):
+    global _learn_templates
+    _learn_templates = templates
+
+
+def _learn_process(args):
+    '''
+    Learns one entry range and returns the non-zero bins of the resulting
+    partial histogram of every pid
+    '''
+    path, tree, start, stop, deps, pids, cutstring = args
+    chunk = read_calibration(
+        path,
+        tree,
+        columns=learn_columns(deps, pids),
+        where=cutstring,
+        start=start,
+        stop=stop)
+    resamplers = {pid: _learn_templates[pid].copy() for pid in pids}
+    learn_chunk(resamplers, chunk, deps, pids)
+    return {pid: resamplers[pid].nonzero_bins() for pid in pids}
+
+
+def learn_parallel(resamplers, data, tree, deps, pids, cutstring, num_cpu):
+    '''
+    Fills the empty resamplers from all entry ranges of the files in `data`
+    using a pool of `num_cpu` processes. The partial histograms are added in
+    the order in which the serial loop reads the chunks, so the result is
+    bitwise identical to it.
+    '''
+    import multiprocessing as mp
+    tasks = [(path, tree, start, stop, deps, pids, cutstring)
+             for path in data
+             for start, stop in _entry_ranges(path, tree, LEARN_CHUNKSIZE)]
+    templates = {pid: resamplers[pid].copy() for pid in pids}
+    assert all(len(t.nonzero_bins()[0]) == 0 for t in templates.values())
+    pool = mp.Pool(
+        processes=num_cpu,
+        initializer=_init_learn_worker,
+        initargs=(templates, ))
+    try:
+        for i, partials in enumerate(pool.imap(_learn_process, tasks)):
+            for pid, (idx, values) in partials.items():
+                resamplers[pid].add_bins(idx, values)
+            logging.info('Finished chunk {} of {}'.format(i + 1, len(tasks)))
+    finally:
+        pool.terminate()
 
 
 def resample_branch(options):
-    from copy import deepcopy
-    for source_file in options.source_files:
-        opt = deepcopy(options)
+    import multiprocessing as mp
+
+    logging.info('Loading config...')
+    with open(options.configfile) as f:
+        config = json.load(f)
+
+    logging.info('Loading resamplers...')
+    resamplers, prefix_dict = load_task_resamplers(config)
+
+    batches = _resampling_batches(options)
+
+    if options.jobs > 1:
+        # Batch mode: the (file, tree) pairs are spread over a pool of
+        # processes that inherit the resamplers loaded above, every process
+        # samples its pairs itself
+        pool = None
+        batch_pool = mp.Pool(
+            processes=options.jobs,
+            initializer=_init_process_worker,
+            initargs=(resamplers, prefix_dict))
+        results = batch_pool.imap_unordered(
+            _resample_batch, [(options, config, b) for b in batches])
+    elif options.profile:
+        # Sample in this process, so that the profiles cover the sampling
+        batch_pool = pool = None
+        _init_worker(resamplers, prefix_dict)
+        results = (_resample_batch((options, config, b), pool)
+                   for b in batches)
+    else:
+        batch_pool = None
+        pool = sampling_pool(options.backend, options.num_cpu, resamplers,
+                             prefix_dict)
+        results = (_resample_batch((options, config, b), pool)
+                   for b in batches)
+
+    statuses = []
+    try:
+        for batch_statuses in results:
+            statuses += batch_statuses
+    finally:
+        for p in (pool, batch_pool):
+            if p is not None:
+                p.terminate()
+        if options.stats:
+            with open(options.stats, 'w') as f:
+                json.dump(statuses, f, indent=2, sort_keys=True)
+
+    failed = [s for s in statuses if s['status'] == 'failed']
+    logging.info('Resampled {} of {} trees, {} skipped, {} failed'.format(
+        sum(s['status'] == 'ok' for s in statuses), len(statuses),
+        sum(s['status'] == 'skipped' for s in statuses), len(failed)))
+    for status in failed:
+        logging.error('Failed: {source_file}:{tree}: {error}'.format(**status))
+    if failed:
+        exit(1)
+
+
+def _resampling_batches(options):
+    '''
+    Returns the (file, tree) pairs to resample, grouped into batches that
+    can be processed in parallel. Directories among the source files are
+    replaced by the .root files in them. Trees of the same file are
+    processed in one batch, unless they are written to separate friend
+    files.
+    '''
+    import os
+    from glob import glob
+    source_files = []
+    for source in options.source_files:
+        if os.path.isdir(source):
+            source_files += sorted(glob(os.path.join(source, '*.root')))
+        else:
+            source_files.append(source)
+
+    trees = options.trees or [options.tree]
+    separate_outputs = options.friend_file is not None and \
+        '{tree}' in options.friend_file
+    if len(trees) > 1 and options.friend_file is not None and \
+            not separate_outputs:
+        logging.error('Use {tree} in --friend-file when resampling several '
+                      'trees.')
+        exit()
+    if len(source_files) > 1 and options.friend_file is not None:
+        stems = [os.path.splitext(f)[0] for f in source_files]
+        if '{stem}' in options.friend_file:
+            unique = len(set(stems)) == len(stems)
+        elif '{name}' in options.friend_file:
+            names = [os.path.basename(stem) for stem in stems]
+            unique = len(set(names)) == len(names)
+        else:
+            unique = False
+        if not unique:
+            logging.error('Use {stem} (or {name} for files with different '
+                          'names) in --friend-file when resampling several '
+                          'files.')
+            exit()
+    if separate_outputs:
+        return [[(f, t)] for f in source_files for t in trees]
+    return [[(f, t) for t in trees] for f in source_files]
+
+
+def sampling_pool(backend, processes, resamplers, prefix_dict):
+    '''
+    Returns the pool that runs resample_process. With the `processes`
+    backend, the resamplers are handed to the workers once when the pool
+    starts. With the default fork start method they are inherited
+    copy-on-write (and memory-mapped stores share the page cache), but the
+    feature arrays and results of every task are pickled. The `threads`
+    backend shares all arrays with the calling process and relies on numpy
+    releasing the GIL in the sampling.
+    '''
+    if backend == 'threads':
+        from multiprocessing.pool import ThreadPool
+        # The worker globals are shared by all threads
+        _init_worker(resamplers, prefix_dict)
+        return ThreadPool(processes=processes)
+    import multiprocessing as mp
+    return mp.Pool(
+        processes=processes,
+        initializer=_init_process_worker,
+        initargs=(resamplers, prefix_dict))
+
+
+def _resample_batch(args, pool=None):
+    '''
+    Resamples a batch of (file, tree) pairs one after the other and returns
+    the status of every pair. Without a pool, the sampling is done in the
+    calling process.
+    '''
+    from copy import copy
+    options, config, pairs = args
+    statuses = []
+    for source_file, tree in pairs:
+        opt = copy(options)
         opt.source_file = source_file
-        _resample_branch(opt)
+        opt.tree = tree
+        status = {'source_file': source_file, 'tree': tree}
+        try:
+            status['summary'] = _resample_branch(opt, config, pool)
+            status['status'] = 'ok'
+        except ResamplingDone as e:
+            logging.info('Skipping {}:{}: {}'.format(source_file, tree, e))
+            status['status'] = 'skipped'
+        except (Exception, SystemExit) as e:
+            logging.exception('Resampling {}:{} failed'.format(
+                source_file, tree))
+            status['status'] = 'failed'
+            status['error'] = repr(e)
+        statuses.append(status)
+    return statuses
+
+
+class ResamplingDone(Exception):
+    pass
+
+
+def load_task_resamplers(config):
+    '''
+    Loads the frozen resamplers for all tasks and backgrounds in the config.
+    Returns a dict mapping the true id (or None) to a dict of resamplers by
+    pid kind and the dict mapping true ids to particle prefixes.
+    '''
+    prefix_dict = {}
+    resamplers = {}
 
+    use_trueid = 'trueid' in config['tasks'][0]
+    for task in config['tasks'][1:]:
+        if use_trueid and not 'trueid' in task \
+                or not use_trueid and 'trueid' in task:
+            logging.error('Specify true ids on all tasks or on no task.')
+            exit()
 
-def _resample_branch(options):
-    import pickle
-    from root_numpy import tree2array, array2tree, list_branches
+    for task in config['tasks'] + config.get('backgrounds', []):
+        resampler = open_resampler_file(task['resampler_path'])
+
+        for trueid in task.get('trueid', [None]):
+            resamplers[trueid] = resamplers.get(trueid, {})
+            if trueid is None:
+                prefix_dict[trueid] = None
+            else:
+                prefix_dict[trueid] = task['pids'][0]['kind'].split('_')[0]
+
+            for pid in task['pids']:
+                if not pid['kind'] in resampler:
+                    logging.error(
+                        'No resampler found for {kind} in {picklefile}'.
+                        format(
+                            kind=pid['kind'],
+                            picklefile=task['resampler_path']))
+                    exit()
+
+                resamplers[trueid][pid['kind']] = load_resampler(
+                    task['resampler_path'], pid['kind'])
+
+    return resamplers, prefix_dict
+
+
+def _resample_branch(options, config, pool):
+    from root_numpy import list_branches
     from root_pandas import read_root
     from pandas import DataFrame
-    import multiprocessing as mp
     logging.info('Starting resampling for {}'.format(options.source_file))
 
-    logging.info('Loading config...')
-    with open(options.configfile) as f:
-        config = json.load(f)
-
     branches_in_file = list_branches(
         options.source_file, treename=options.tree)
 
@@ -300,49 +1604,14 @@ def _resample_branch(options):
                 pid_names.append(pid['name'].replace('Trafo', 'Untrafo'))
 
     if all([pid_name in branches_in_file for pid_name in pid_names]):
-        raise Exception(
+        raise ResamplingDone(
             'Branches exist - resampling seems to be done already.')
 
-    logging.info('Loading resamplers...')
-
-    trueid_branches = []
-    prefix_dict = {}
-    # load resamplers into config dictionary
-    resamplers = {}
-
-    use_trueid = 'trueid' in config['tasks'][0]
-    for task in config['tasks'][1:]:
-        if use_trueid and not 'trueid' in task \
-                or not use_trueid and 'trueid' in task:
-            logging.error('Specify true ids on all tasks or on no task.')
-            exit()
-
-    for task in config['tasks'] + config.get('backgrounds', []):
-        if 'trueid_branch' in task:
-            trueid_branches.append(task['trueid_branch'])
-        with open(task['resampler_path'], 'rb') as f:
-            try:
-                resampler = pickle.load(f)
-            except UnicodeDecodeError:  # pickled with python2
-                resampler = pickle.load(f, encoding='latin1')
-
-            for trueid in task.get('trueid', [None]):
-                resamplers[trueid] = resamplers.get(trueid, {})
-                if trueid is None:
-                    prefix_dict[trueid] = None
-                else:
-                    prefix_dict[trueid] = task['pids'][0]['kind'].split('_')[0]
-
-                for pid in task['pids']:
-                    if not pid['kind'] in resampler:
-                        logging.error(
-                            'No resampler found for {kind} in {picklefile}'.
-                            format(
-                                kind=pid['kind'],
-                                picklefile=task['resampler_path']))
-                        exit()
-
-                    resamplers[trueid][pid['kind']] = resampler[pid['kind']]
+    trueid_branches = [
+        task['trueid_branch']
+        for task in config['tasks'] + config.get('backgrounds', [])
+        if 'trueid_branch' in task
+    ]
 
     needed_branches = [f for task in config['tasks'] for f in task['features']]
 
@@ -363,96 +1632,579 @@ def _resample_branch(options):
                 exit()
     needed_branches = list(set(needed_branches))
 
+    # Plan the sampling calls up front: pids of all tasks that use the same
+    # resampler and kind are sampled in one call with the features of their
+    # tasks concatenated, the result is split up into the branches later
+    plan = {}
+    plan_keys = []
+    var_names = []
+    for task in config['tasks']:
+        for pid in task['pids']:
+            if pid['name'] in branches_in_file:
+                logging.info('Skipping {}, branch already exists'.format(
+                    pid['name']))
+                continue
+            key = (task['resampler_path'], pid['kind'], 'trueid_branch' in
+                   task)
+            if key not in plan:
+                plan[key] = []
+                plan_keys.append(key)
+            plan[key].append((task, pid['name']))
+            var_names.append(pid['name'])
+
     logging.info('Starting resampling...')
 
-    resampled_data = DataFrame()
+    telemetry = Telemetry(
+        options.source_file,
+        n_entries(options.source_file, options.tree),
+        profile_dir=options.profile)
 
-    chunksize = options.chunksize
-    for i, chunk in enumerate(
-            read_root(
-                options.source_file,
-                options.tree,
-                columns=needed_branches + trueid_branches,
-                chunksize=chunksize)):
+    # Resampled branches are written chunk by chunk, so memory usage only
+    # depends on the chunksize and not on the size of the tuple
+    with telemetry.stage('write'):
+        writer = open_branch_writer(options)
 
-        for ps in pseudorapidities_to_calculate:
-            logging.info('Calculating pseudorapidity for {}'.format(ps))
-            p = chunk[ps + '_P']
-            pz = chunk[ps + '_PZ']
-            chunk[ps + '_eta'] = 0.5 * np.log((p + pz) / (p - pz))
+    # Every sampling call of a chunk is split into entry ranges, so that
+    # the pool has enough tasks even if the config only has a few pids
+    if pool is None:
+        n_slices = 1
+    else:
+        n_slices = -(-options.num_cpu // max(1, len(plan_keys)))
 
-        resampled_data_chunk = DataFrame()
-        var_name = []
-        args = []
-
-        for task in config['tasks']:
-            deps = chunk[task['features']]
+    def finish(pending):
+        '''
+        Waits for the sampling of a chunk, then back transforms and writes it
+        '''
+        slices, results = pending
+        with telemetry.stage('dispatch'):
+            if pool is not None:
+                results = results.get()
+        telemetry.add('sampling', sum(seconds for _, seconds in results))
+
+        resampled = {name: [] for name in var_names}
+        results = iter(results)
+        for start, stop in slices:
+            n = stop - start
+            for key in plan_keys:
+                res, _ = next(results)
+                for j, (_, name) in enumerate(plan[key]):
+                    resampled[name].append(res[j * n:(j + 1) * n])
+        resampled = {
+            name: np.concatenate(parts)
+            for name, parts in resampled.items()
+        }
 
-            if 'trueid_branch' in task:
-                trueid = chunk[task['trueid_branch']]
+        # transform branches back
+        resampled_data_chunk = DataFrame()
+        with telemetry.stage('back_transform'):
+            for var in var_names:
+                resampled_data_chunk[var] = resampled[var]
+                if 'Trafo' in var and options.transform:
+                    logging.debug('Back trafo for {}'.format(var))
+                    resampled_data_chunk[var.replace('Trafo', 'Untrafo')] = \
+                        back_transform(resampled[var])
+
+        with telemetry.stage('write'):
+            writer.fill(resampled_data_chunk.to_records(index=False))
+        telemetry.chunk_done(slices[-1][1])
+
+    def read():
+        '''
+        Yields the chunks of the source tree with the pseudorapidities added,
+        together with the keys of their events for --seed
+        '''
+        # Entry number of the first event of the current chunk
+        offset = 0
+        chunks = iter(
+            read_root(
+                options.source_file,
+                options.tree,
+                columns=needed_branches + trueid_branches + [
+                    k for k in options.event_keys or []
+                    if k not in needed_branches + trueid_branches
+                ],
+                chunksize=options.chunksize))
+        while True:
+            with telemetry.stage('read'):
+                chunk = next(chunks, None)
+            if chunk is None:
+                return
+
+            with telemetry.stage('eta'):
+                for ps in pseudorapidities_to_calculate:
+                    logging.debug(
+                        'Calculating pseudorapidity for {}'.format(ps))
+                    p = chunk[ps + '_P']
+                    pz = chunk[ps + '_PZ']
+                    chunk[ps + '_eta'] = 0.5 * np.log((p + pz) / (p - pz))
+
+            if options.event_keys:
+                event_keys = [chunk[k].values for k in options.event_keys]
             else:
-                trueid = None
+                event_keys = [np.arange(offset, offset + len(chunk))]
+            offset += len(chunk)
+            yield chunk, event_keys
 
-            for pid in task['pids']:
-                if pid['name'] in branches_in_file:
-                    logging.info('Skipping {}, branch already exists'.format(
-                        pid['name']))
-                    continue
+    def sample(item):
+        '''
+        Submits the sampling calls of a chunk to the pool
+        '''
+        chunk, event_keys = item
+        with telemetry.stage('plan'):
+            features = {
+                id(task): chunk[task['features']].values.T
+                for task in config['tasks']
+            }
+            slices = _sampling_slices(len(chunk), n_slices)
+            args = []
+            for start, stop in slices:
+                for key in plan_keys:
+                    members = plan[key]
+                    deps = np.hstack([
+                        features[id(task)][:, start:stop]
+                        for task, _ in members
+                    ])
+                    if key[2]:
+                        trueid = np.concatenate([
+                            chunk[task['trueid_branch']].values[start:stop]
+                            for task, _ in members
+                        ])
+                    else:
+                        trueid = None
+                    rng = None
+                    if options.seed is not None:
+                        rng = (options.seed,
+                               [k[start:stop] for k in event_keys], [
+                                   branch_stream(name) for _, name in members
+                               ])
+                    args.append((deps, trueid, key[1], rng))
+
+        with telemetry.stage('dispatch'):
+            if pool is None:
+                return slices, list(map(_resample_timed, args))
+            return slices, pool.map_async(_resample_timed, args)
+
+    if options.prefetch > 0 and options.friend_file is not None \
+            and not options.profile:
+        # Reading, sampling and writing run concurrently in their own
+        # threads, connected by queues that hold up to --prefetch chunks
+        R.EnableThreadSafety()
+        run_pipeline(read(), sample, finish, options.prefetch)
+    else:
+        # The chunk that is being sampled by the pool while the next one is
+        # read
+        pending = None
+        for item in read():
+            submitted = sample(item)
+            if pending is not None:
+                finish(pending)
+            pending = submitted
+        if pending is not None:
+            finish(pending)
+
+    logging.info('Writing output...')
+    with telemetry.stage('write'):
+        writer.close()
+    return telemetry.finish()
+
+
+def run_pipeline(source, process, sink, depth):
+    '''
+    Runs a three stage pipeline: a reader thread iterates over `source`, the
+    calling thread applies `process` to every item and a writer thread
+    passes the results to `sink`, in the order of `source`. The stages are
+    connected by queues that hold at most `depth` items, so the reader can
+    only run `depth` items ahead. If a stage fails, the others are stopped
+    and the exception is raised in the calling thread.
+    '''
+    import queue
+    import threading
+
+    done = object()
+    stop = threading.Event()
+    errors = []
+    read_queue = queue.Queue(maxsize=depth)
+    write_queue = queue.Queue(maxsize=depth)
+
+    def put(q, item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(q):
+        while not stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return done
+
+    def reader():
+        try:
+            for item in source:
+                if not put(read_queue, item):
+                    return
+            put(read_queue, done)
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+
+    def writer():
+        try:
+            while True:
+                item = get(write_queue)
+                if item is done:
+                    return
+                sink(item)
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+
+    threads = [
+        threading.Thread(target=reader, name='reader'),
+        threading.Thread(target=writer, name='writer')
+    ]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        while True:
+            item = get(read_queue)
+            if item is done or not put(write_queue, process(item)):
+                break
+        put(write_queue, done)
+    except BaseException:
+        stop.set()
+        raise
+    finally:
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
+
+
+# Smallest number of entries that is worth a separate sampling task
+MIN_SAMPLING_SLICE = 10000
+
+
+def _sampling_slices(n, n_slices):
+    '''
+    Splits the entries of a chunk into at most `n_slices` contiguous ranges
+    of at least MIN_SAMPLING_SLICE entries
+    '''
+    n_slices = max(1, min(n_slices, n // MIN_SAMPLING_SLICE))
+    bounds = np.linspace(0, n, n_slices + 1).astype(int)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+class Telemetry:
+    '''
+    Collects the wall time, number of calls and memory usage of every stage
+    of a resampling run and logs the throughput after every chunk. For the
+    memory, the change of the current resident set size during every stage
+    is summed up (`rss_delta_mb`) and the largest resident set size at the
+    end of a stage is kept (`rss_after_mb`). When the stages run in
+    different threads (see run_pipeline), their deltas overlap. The peak
+    resident set size of the whole process is part of the summary. With a
+    `profile_dir`, every stage is also run under cProfile and the statistics
+    are dumped to `<profile_dir>/<stage>.prof` by `finish`.
+    '''
+
+    def __init__(self, name, total_entries=None, profile_dir=None):
+        import threading
+        import time
+        self.name = name
+        self.total_entries = total_entries
+        self.profile_dir = profile_dir
+        self.start = time.time()
+        self.processed = 0
+        self.stages = {}
+        self.profiles = {}
+        # Stages may run in different threads, see run_pipeline
+        self.lock = threading.Lock()
+
+    def _stage(self, name):
+        return self.stages.setdefault(name, {
+            'seconds': 0.,
+            'calls': 0
+        })
+
+    def add(self, name, seconds, rss_before=None):
+        '''
+        Accounts a call that took `seconds` to the stage `name`. The memory
+        is only recorded if the resident set size before the call is given.
+        '''
+        rss = _current_rss_mb() if rss_before is not None else None
+        with self.lock:
+            stage = self._stage(name)
+            stage['seconds'] += seconds
+            stage['calls'] += 1
+            if rss is not None:
+                stage['rss_delta_mb'] = stage.get('rss_delta_mb',
+                                                  0.) + rss - rss_before
+                stage['rss_after_mb'] = max(
+                    stage.get('rss_after_mb', 0.), rss)
+
+    def stage(self, name):
+        '''
+        Returns a context manager that accounts the time spent in it to the
+        stage `name`
+        '''
+        from contextlib import contextmanager
+        import time
+
+        @contextmanager
+        def timed():
+            profile = None
+            if self.profile_dir:
+                import cProfile
+                profile = self.profiles.setdefault(name, cProfile.Profile())
+                profile.enable()
+            rss_before = _current_rss_mb()
+            start = time.time()
+            try:
+                yield
+            finally:
+                if profile is not None:
+                    profile.disable()
+                self.add(name, time.time() - start, rss_before)
+
+        return timed()
+
+    def chunk_done(self, n):
+        import time
+        with self.lock:
+            self.processed += n
+        elapsed = time.time() - self.start
+        rate = self.processed / elapsed if elapsed > 0 else 0.
+        if self.total_entries and rate > 0:
+            eta = (self.total_entries - self.processed) / rate
+            logging.info(
+                'Processed {} of {} entries ({:.0f} events/s, ETA {:.0f} s)'.
+                format(self.processed, self.total_entries, rate, eta))
+        else:
+            logging.info('Processed {} entries ({:.0f} events/s)'.format(
+                self.processed, rate))
 
-                var_name.append(pid['name'])
-                args.append((resamplers, deps.values.T, trueid, pid['kind'],
-                             prefix_dict))
+    def finish(self):
+        '''
+        Logs and returns a summary of the run and dumps the profiles
+        '''
+        import os
+        import time
+        elapsed = time.time() - self.start
+        if self.profile_dir:
+            if not os.path.exists(self.profile_dir):
+                os.makedirs(self.profile_dir)
+            prefix = os.path.splitext(os.path.basename(self.name))[0]
+            for name, profile in self.profiles.items():
+                profile.dump_stats(
+                    os.path.join(self.profile_dir, '{}_{}.prof'.format(
+                        prefix, name)))
+        summary = {
+            'source_file': self.name,
+            'entries': self.processed,
+            'seconds': elapsed,
+            'events_per_second':
+            self.processed / elapsed if elapsed > 0 else None,
+            'max_rss_mb': _max_rss_mb(),
+            'stages': self.stages
+        }
+        for name in sorted(self.stages, key=lambda n: -self.stages[n][
+                'seconds']):
+            logging.info('{:<15} {:>10.2f} s in {:>6} calls'.format(
+                name, self.stages[name]['seconds'],
+                self.stages[name]['calls']))
+        return summary
+
+
+def _current_rss_mb():
+    '''
+    Returns the current resident set size of the process in MB, or None where
+    /proc is not available
+    '''
+    import os
+    try:
+        with open('/proc/self/statm') as f:
+            resident = int(f.read().split()[1])
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+    return resident * os.sysconf('SC_PAGE_SIZE') / 1024.**2
 
-        p = mp.Pool(processes=options.num_cpu)
-        resampled = p.map(resample_process, args)
-        p.terminate()
 
-        # transform branches back
-        for idx, var in enumerate(var_name):
-            resampled_data_chunk[var] = resampled[idx]
-            if 'Trafo' in var and options.transform:
-                logging.info('Back trafo for {}'.format(var))
-                resampled_data_chunk[var.replace('Trafo', 'Untrafo')] = \
-                    back_transform(resampled[idx])
+def _max_rss_mb():
+    import resource
+    # ru_maxrss is given in kB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
 
-        logging.info('Processed {} entries'.format((i + 1) * chunksize))
-        resampled_data = resampled_data.append(
-            resampled_data_chunk, ignore_index=True)
 
-    logging.info('Writing output...')
-    f = R.TFile(options.source_file, 'UPDATE')
-    t = f.Get(options.tree)
-    if '/' in options.tree:
-        t_path = options.tree.split('/')[:-1]
-        t_dir = f.Get('/'.join(t_path))
-        t_dir.cd()
-    print(resampled_data.tail())
-    array2tree(
-        resampled_data.to_records(index=False), tree=t, name=options.tree)
-    t.Write()
-    f.Close()
+def open_branch_writer(options):
+    '''
+    Returns the writer for the resampled branches of `options.source_file`.
+    Without --friend-file the branches are added to the source tree itself.
+    '''
+    import os
+    tree = options.tree or _only_tree(options.source_file)
+    if options.friend_file is None:
+        return InPlaceBranchWriter(
+            options.source_file, tree, float32=options.float32)
+
+    stem = os.path.splitext(options.source_file)[0]
+    path = options.friend_file.format(
+        stem=stem, name=os.path.basename(stem), tree=tree.replace('/', '_'))
+    name = options.outputtree or tree.split('/')[-1]
+    logging.info('Writing resampled branches to tree {} in {}'.format(
+        name, path))
+    return FriendTreeWriter(
+        path, name, compression=options.compression, float32=options.float32)
+
+
+def _only_tree(path):
+    '''
+    Returns the name of the tree in `path`, which read_root reads when no
+    tree is given
+    '''
+    from root_numpy import list_trees
+    trees = sorted(set(list_trees(path)))
+    if len(trees) != 1:
+        raise ValueError('More than one tree found in {}, use --tree'.format(
+            path))
+    return trees[0]
+
+
+def _as_float32(records):
+    return records.astype([(name, np.float32)
+                           for name in records.dtype.names])
+
+
+class InPlaceBranchWriter:
+    '''
+    Adds branches to an existing tree. Every call to `fill` extends the
+    branches by one chunk of entries, the tree header is written on `close`.
+    '''
+
+    def __init__(self, path, tree, float32=False):
+        self.float32 = float32
+        self.file = R.TFile(path, 'UPDATE')
+        self.tree = self.file.Get(tree)
+        if '/' in tree:
+            t_path = tree.split('/')[:-1]
+            t_dir = self.file.Get('/'.join(t_path))
+            t_dir.cd()
+
+    def fill(self, records):
+        from root_numpy import array2tree
+        if self.float32:
+            records = _as_float32(records)
+        array2tree(records, tree=self.tree)
+
+    def close(self):
+        self.tree.Write()
+        self.file.Close()
+
+
+class FriendTreeWriter:
+    '''
+    Writes only the resampled branches to a new tree in a separate file.
+    Entries are written in the order of the source tree, so the result can be
+    attached to it with TTree::AddFriend. The source file is only read.
+    '''
+
+    def __init__(self, path, name, compression=None, float32=False):
+        self.name = name
+        self.float32 = float32
+        self.tree = None
+        self.file = R.TFile(path, 'RECREATE')
+        if compression is not None:
+            self.file.SetCompressionSettings(compression)
+
+    def fill(self, records):
+        from root_numpy import array2tree
+        if self.float32:
+            records = _as_float32(records)
+        self.file.cd()
+        self.tree = array2tree(records, name=self.name, tree=self.tree)
+
+    def close(self):
+        if self.tree is not None:
+            self.file.cd()
+            self.tree.Write()
+        self.file.Close()
+
+
+# Resamplers published to the worker processes by _init_worker
+_worker_resamplers = None
+_worker_prefix_dict = None
+
+
+def _init_worker(resamplers, prefix_dict):
+    global _worker_resamplers, _worker_prefix_dict
+    _worker_resamplers = resamplers
+    _worker_prefix_dict = prefix_dict
+
+
+def _init_process_worker(resamplers, prefix_dict):
+    '''
+    Initializer of worker processes. Forked processes inherit the numpy
+    random state of the parent, so without --seed every worker would draw
+    the same numbers. They are reseeded with fresh entropy instead.
+    '''
+    np.random.seed()
+    _init_worker(resamplers, prefix_dict)
+
+
+def _resample_timed(res_deps):
+    import time
+    start = time.time()
+    res = resample_process(res_deps)
+    return res, time.time() - start
 
 
 def resample_process(res_deps):
-    resamplers, deps, trueid, pid, prefix_dict = res_deps
-    res = np.zeros(deps.shape[1])
-    mask = np.ones(deps.shape[1], dtype=bool)
-
-    for t in prefix_dict:
-        if t is None:
-            res = resamplers[t][pid].sample(deps)
-            mask[:] = False
+    '''
+    Samples the pid `pid` for all events. With true ids, the events are
+    grouped by true id once and every group is sampled with one call to the
+    resampler of its particle. Events whose true id has no resampler are set
+    to -9999. `rng` is None to draw from numpy.random or a tuple of the seed,
+    the event keys and one stream per concatenated branch for
+    counter_uniforms.
+    '''
+    deps, trueid, pid, rng = res_deps
+    resamplers = _worker_resamplers
+    prefix_dict = _worker_prefix_dict
+
+    uniforms = None
+    if rng is not None:
+        # Counter-based random numbers, see counter_uniforms
+        seed, keys, streams = rng
+        uniforms = np.hstack(
+            [counter_uniforms(seed, keys, stream) for stream in streams])
+
+    if None in prefix_dict:
+        res = resamplers[None][pid].sample(deps, uniforms)
+    else:
+        res = np.full(deps.shape[1], -9999.)
+    if trueid is None:
+        return res
+
+    values, inverse = np.unique(trueid, return_inverse=True)
+    order = np.argsort(inverse, kind='stable')
+    bounds = np.append([0], np.cumsum(np.bincount(inverse)))
+    sorted_deps = deps[:, order]
+    sorted_res = res[order]
+    pid_tail = '_'.join(pid.split('_')[1:])
+    for t, start, stop in zip(values, bounds[:-1], bounds[1:]):
+        if t not in prefix_dict:
             continue
-
-        idx = np.array(trueid == t, dtype=bool)
-        if (idx == False).all(): continue
-
-        mask[idx] = False
-        pid_tail = '_'.join(pid.split('_')[1:])
         pid_name = '_'.join([prefix_dict[t], pid_tail])
-        res[idx] = resamplers[t][pid_name].sample(deps[:, idx])
-
-    res[mask] = -9999
+        sorted_res[start:stop] = resamplers[t][pid_name].sample(
+            sorted_deps[:, start:stop],
+            None if uniforms is None else uniforms[:, order[start:stop]])
+    res[order] = sorted_res
 
     return res
 
@@ -477,13 +2229,22 @@ grab.add_argument(
     nargs='*',
     help='Optional subset of particles for which calibration data will be '
     'downloaded.')
+grab.add_argument(
+    '--jobs',
+    '-j',
+    default=1,
+    type=int,
+    help='Number of input files that are downloaded and converted '
+    'concurrently. Default: 1')
 
 create = subparsers.add_parser(
     'create_resamplers', help='Generates resampling histograms from NTuples')
 create.set_defaults(func=create_resamplers)
 create.add_argument('location', help='Directory where input files are stored.')
 create.add_argument(
-    'saveto', help='Directory where to save the resamplers as .pkl - files.')
+    'saveto',
+    help='Directory where to save the resamplers as .pkl - files or '
+    '.resamplers - stores.')
 create.add_argument(
     '--particles',
     nargs='*',
@@ -498,6 +2259,69 @@ create.add_argument(
     default=False,
     help='Create a resampler that combines the raw data for magup and magdown.'
 )
+create.add_argument(
+    '--binning-scheme',
+    help='Name of the PIDCalib binning scheme for P, ETA and nTracks, e.g. '
+    'highres. Default: the default scheme of the particle type')
+create.add_argument(
+    '--adaptive-binning',
+    action='store_true',
+    default=False,
+    help='Derive the binning from weighted quantiles of the calibration data '
+    'instead of using a fixed scheme. The edges are stored with the '
+    'resamplers.')
+create.add_argument(
+    '--target-occupancy',
+    type=float,
+    default=1000.,
+    help='Adaptive binning: (weighted) number of events per kinematic cell. '
+    'Bins are removed until at most 5%% of the occupied cells hold fewer '
+    'events. This is not a strict minimum, the achieved occupancy is logged. '
+    'Default: 1000')
+create.add_argument(
+    '--memory-budget',
+    type=float,
+    default=1024.,
+    help='Adaptive binning: maximum size of the histograms of all resamplers '
+    'of a sample in MB. Default: 1024')
+create.add_argument(
+    '--adaptive-sample',
+    type=int,
+    default=1000000,
+    help='Adaptive binning: number of calibration entries used to derive the '
+    'binning. Default: 1000000')
+create.add_argument(
+    '--sparse',
+    action='store_true',
+    default=False,
+    help='Only store occupied bins. Use this for fine binning schemes whose '
+    'dense histograms would not fit into memory.')
+create.add_argument(
+    '--num_cpu',
+    '-n',
+    help='Number of processes that fill the histograms in parallel. The '
+    'result is identical to the one of a single process.',
+    default=1,
+    type=int)
+create.add_argument(
+    '--cache',
+    help='Directory in which the histograms of every input file are cached. '
+    'When resamplers are created again, only new or changed input files are '
+    'read, the histograms of all others are taken from the cache.')
+create.add_argument(
+    '--format',
+    choices=['pickle', 'store'],
+    default='pickle',
+    help='Output format. "pickle" writes one .pkl file per sample, "store" '
+    'writes a .resamplers directory with memory-mapped, frozen tables that '
+    'are loaded lazily per pid. Default: pickle')
+create.add_argument(
+    '--freeze',
+    action='store_true',
+    default=False,
+    help='Store sampling-only resamplers with precomputed cumulative tables '
+    'instead of the raw histograms. They are faster to load and sample from '
+    'but cannot be merged or refilled.')
 create.add_argument(
     '-c',
     '--config',
@@ -513,14 +2337,27 @@ resample = subparsers.add_parser(
     help='Uses histograms to add resampled PID branches to a dataset')
 resample.set_defaults(func=resample_branch)
 resample.add_argument('configfile')
-resample.add_argument('source_files', nargs='+')
+resample.add_argument(
+    'source_files',
+    nargs='+',
+    help='Files to resample. For directories, all .root files in them are '
+    'resampled.')
 # resample.add_argument('output_file')
 resample.add_argument(
     '--num_cpu',
     '-n',
-    help='Number of cpus used for resampling',
+    help='Number of cpus used for resampling. The entries of every chunk '
+    'are split up, so that all cpus are used even for a single pid. The next '
+    'chunk is read while the current one is sampled.',
     default=1,
     type=int)
+resample.add_argument(
+    '--backend',
+    choices=['processes', 'threads'],
+    default='processes',
+    help='Run the --num_cpu sampling workers as processes or as threads. '
+    'Threads share the resamplers and arrays without pickling them. '
+    'Default: processes')
 resample.add_argument(
     '--chunksize',
     help='Size of the chunks that are read from the root file',
@@ -530,6 +2367,17 @@ resample.add_argument(
     '--tree',
     help='Optional tree name to use. Should be used if you have '
     'multiple trees in file.')
+resample.add_argument(
+    '--trees',
+    nargs='+',
+    help='Resample several trees of every source file. Overrides --tree.')
+resample.add_argument(
+    '--jobs',
+    '-j',
+    help='Number of (file, tree) pairs that are resampled in parallel. Each '
+    'job samples in its own process, --num_cpu is then ignored.',
+    default=1,
+    type=int)
 resample.add_argument(
     '--outputtree',
     help='Optional tree name to use. Should be used if you have multiple trees'
@@ -538,6 +2386,50 @@ resample.add_argument(
     '--transform',
     action='store_true',
     help='Perform in place back transformation for ProbNN variables')
+resample.add_argument(
+    '--prefetch',
+    type=int,
+    default=2,
+    help='With --friend-file, reading, sampling and writing run in '
+    'separate threads and up to this many chunks are read ahead. 0 processes '
+    'the chunks one after another. Default: 2')
+resample.add_argument(
+    '--seed',
+    type=int,
+    help='Seed for reproducible resampling. The random numbers of every '
+    'event are derived from the seed, the branch name and the event keys, so '
+    'the result does not depend on --chunksize, --num_cpu or --jobs. '
+    'Default: draw from the unseeded numpy random state')
+resample.add_argument(
+    '--event-keys',
+    nargs='+',
+    help='Branches that identify an event for --seed, e.g. runNumber '
+    'eventNumber. Default: the entry number')
+resample.add_argument(
+    '--stats',
+    help='Write a JSON summary with the status of every (file, tree) pair '
+    'and the time, number of calls and memory usage of all stages to this '
+    'file')
+resample.add_argument(
+    '--profile',
+    help='Run every stage under cProfile and write the statistics to this '
+    'directory. The sampling then runs in the main process.')
+resample.add_argument(
+    '--friend-file',
+    help='Write the resampled branches to a separate file instead of adding '
+    'them to the source tree. The file holds a single friend tree that is '
+    'aligned with the source tree by entry number. {stem} is replaced by '
+    'the path of the source file without extension, {name} by its file '
+    'name and {tree} by the tree name, e.g. "{stem}_pid.root".')
+resample.add_argument(
+    '--compression',
+    type=int,
+    help='ROOT compression setting (100 * algorithm + level) of the friend '
+    'file, e.g. 404 for LZ4 level 4. Default: ROOT default')
+resample.add_argument(
+    '--float32',
+    action='store_true',
+    help='Store the resampled branches as single precision floats')
 
 if __name__ == '__main__':
     options = parser.parse_args()